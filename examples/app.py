@@ -4,6 +4,7 @@ import os
 import sys
 import logging
 import signal
+import socket
 from abc import ABC
 
 import tornado.ioloop
@@ -12,11 +13,16 @@ import tornado.web
 import loopback.handlers
 import rooms.handlers
 import multires.handlers
+import broadcast.handlers
+import sharding
 import tornado.httpserver
 
 from tornado.platform.asyncio import AsyncIOMainLoop
 import asyncio
 from pykurento import KurentoClient
+from pykurento.reaper import PipelineLeases, PipelineReaper
+from pykurento.stats import ServerLoadSampler
+from rooms.state import open_state
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 logger = logging.getLogger(__name__)
@@ -38,6 +44,11 @@ class IndexHandler(tornado.web.RequestHandler, ABC):
 
 
 if __name__ == "__main__":
+    kurento_url = "wss://jitsimk.ir/kurento"
+    # with WORKERS > 0, group call rooms are sharded over that many worker processes
+    workers = int(os.environ.get("WORKERS", 0))
+    worker_paths = sharding.start_workers(workers, kurento_url) if workers else []
+
     aio = AsyncIOMainLoop()
     aio.install()
     loop = asyncio.get_event_loop()
@@ -45,10 +56,13 @@ if __name__ == "__main__":
     application = tornado.web.Application([
         (r"/", IndexHandler),
         (r"/loopback/websocket", loopback.handlers.LoopbackWebSocketHandler),
-        (r"/groupcall", rooms.handlers.GroupCallWebSocketHandler),
+        (r"/groupcall", sharding.ShardedGroupCallWebSocketHandler if workers
+         else rooms.handlers.GroupCallWebSocketHandler),
         (r"/loopback", loopback.handlers.LoopbackHandler),
         (r"/multires", multires.handlers.MultiResHandler),
         (r"/room", rooms.handlers.RoomIndexHandler),
+        (r"/broadcast", broadcast.handlers.BroadcastHandler),
+        (r"/broadcast/websocket", broadcast.handlers.BroadcastWebSocketHandler),
         # (r"/room/(?P<room_id>\d*)", rooms.handlers.RoomHandler),
         # (r"/room/(?P<room_id>[^/]*)/subscribe/(?P<from_participant_id>[^/]*)/(?P<to_participant_id>[^/]*)",
         #  rooms.handlers.SubscribeToParticipantHandler),
@@ -60,12 +74,37 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
 
-    kurento = KurentoClient(url="wss://jitsimk.ir/kurento")
+    # KURENTO_IO_THREAD=1 keeps KMS traffic on its own thread, away from template rendering and handlers
+    # pipelines are tagged with this instance and a lease, so others can release them if we die
+    leases = PipelineLeases(owner="{host}-{pid}".format(host=socket.gethostname(), pid=os.getpid()))
+    kurento = KurentoClient(url=kurento_url, leases=leases, threaded=bool(os.environ.get("KURENTO_IO_THREAD")))
 
     # Start connection and get client connection protocol
     connection = loop.run_until_complete(kurento.get_transport().connect())
+    tasks = [
+        asyncio.ensure_future(kurento.get_transport().receive_message()),
+        asyncio.ensure_future(kurento.get_transport().process_messages()),
+    ]
 
     setattr(application, "kurento", kurento)
+    leases.start()
+
+    # KURENTO_STATE_URL=redis://host:6379/0 records rooms there, so a restarted instance takes them back
+    state_url = os.environ.get("KURENTO_STATE_URL")
+    if workers:
+        loop.run_until_complete(sharding.ShardedGroupCallWebSocketHandler.configure(worker_paths))
+    else:
+        # sample WebRtcEndpoint stats of every participant in the group call rooms
+        rooms.handlers.GroupCallWebSocketHandler.stats.start()
+        rooms.handlers.GroupCallWebSocketHandler.server_load = ServerLoadSampler(kurento)
+        rooms.handlers.GroupCallWebSocketHandler.server_load.start()
+        if state_url:
+            rooms.handlers.GroupCallWebSocketHandler.state = open_state(state_url)
+            # before starting the reaper, while the leases of our previous run still hold
+            loop.run_until_complete(rooms.handlers.GroupCallWebSocketHandler.setup(kurento).restore())
+
+    # releases pipelines left behind by instances that crashed or were restarted
+    PipelineReaper(kurento, lease_duration=leases.duration).start()
 
     http_server = tornado.httpserver.HTTPServer(application, ssl_options={
         "certfile": os.path.join(os.path.dirname(__file__), "server.crt"),
@@ -85,11 +124,6 @@ if __name__ == "__main__":
     # concurrent
 
     try:
-        tasks = [
-            asyncio.ensure_future(kurento.get_transport().receive_message()),
-            asyncio.ensure_future(kurento.get_transport().process_messages()),
-        ]
-
         asyncio.gather(*tasks)
 
         loop.run_forever()
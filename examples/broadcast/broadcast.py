@@ -0,0 +1,223 @@
+import asyncio
+import logging
+
+from collections import deque
+
+from pykurento import media
+from pykurento.media import MediaPipeline
+from signalling import IceCandidateBatcher
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastPeer:
+    '''A presenter or a viewer: one WebRtcEndpoint plugged into the dispatcher through a hub port'''
+
+    def __init__(self, endpoint: media.WebRtcEndpoint, hub_port: media.HubPort):
+        self.endpoint = endpoint
+        self.hub_port = hub_port
+        self.session = None
+        self.candidates = None
+
+    async def subscribe_ice_events(self):
+        await self.endpoint.on_ice_candidate_found_event(self.ice_candidate_found_event, session=None, name=None)
+        await self.endpoint.on_ice_gathering_done_event(self.ice_gathering_done_event, session=None, name=None)
+
+    def attach(self, session, send):
+        self.session = session
+        self.candidates = IceCandidateBatcher(send, overflow=lambda name: session.close(1008, "Slow consumer"))
+
+    async def ice_candidate_found_event(self, event, endpoint, session, name):
+        if self.candidates is not None:
+            self.candidates.add(None, event.candidate)
+
+    async def ice_gathering_done_event(self, event, endpoint, session, name):
+        if self.candidates is not None:
+            await self.candidates.flush(None)
+
+    async def release(self):
+        if self.candidates is not None:
+            self.candidates.discard()
+        await self.hub_port.release()
+        await self.endpoint.release()
+
+
+class Broadcast:
+    '''
+        One presenter streamed to many viewers through a DispatcherOneToMany
+
+        Swapping the presenter only changes the dispatcher source, viewers keep their
+        endpoints. Viewer joins are queued and admitted in batches of up to `max_batch`
+        every `batch_window` seconds, with at most `max_concurrency` viewers being set up
+        at once; `pool_size` viewer endpoints are created and plugged in ahead of time.
+    '''
+
+    def __init__(self, name: str, pipeline: MediaPipeline, batch_window=0.05, max_batch=50, max_concurrency=10,
+                 pool_size=0):
+        self.name = name
+        self.pipeline = pipeline
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pool_size = pool_size
+
+        self.dispatcher = None
+        self.presenter = None
+        self.viewers = {}
+
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__admissions = deque()
+        self.__admission_pending = asyncio.Event()
+        self.__pool = []
+        self.__warming = 0
+        self.__prewarming = set()
+        self.__worker = None
+
+    async def create(self):
+        self.dispatcher = await media.DispatcherOneToMany(self.pipeline)
+        self.__worker = asyncio.ensure_future(self.__admit_batches())
+        await self.prewarm(self.pool_size)
+
+    async def __create_peer(self, presenter=False) -> BroadcastPeer:
+        async with self.__semaphore:
+            endpoint = await media.WebRtcEndpoint(self.pipeline)
+            hub_port = await self.dispatcher.create_hub_port()
+            if presenter:
+                await endpoint.connect(hub_port)
+            else:
+                await hub_port.connect(endpoint)
+            peer = BroadcastPeer(endpoint, hub_port)
+            await peer.subscribe_ice_events()
+            return peer
+
+    async def prewarm(self, count: int):
+        # endpoints still being created count as pooled, so overlapping calls don't overshoot
+        missing = count - len(self.__pool) - self.__warming
+        if missing <= 0:
+            return
+        logger.debug("BROADCAST {name}: creating {count} viewer endpoints ahead".format(name=self.name,
+                                                                                      count=missing))
+        self.__warming += missing
+        try:
+            peers = await asyncio.gather(*[self.__create_peer() for _ in range(missing)], return_exceptions=True)
+        finally:
+            self.__warming -= missing
+        for peer in peers:
+            if isinstance(peer, BaseException):
+                logger.warning("BROADCAST {name}: could not create a viewer endpoint ahead: {error}".format(
+                    name=self.name, error=peer))
+            else:
+                self.__pool.append(peer)
+
+    async def set_presenter(self, session, send, sdp_offer: str) -> str:
+        peer = await self.__create_peer(presenter=True)
+        peer.attach(session, send)
+        try:
+            sdp_answer = await peer.endpoint.process_offer(sdp_offer)
+            await self.dispatcher.set_source(peer.hub_port)
+        except Exception:
+            await peer.release()
+            raise
+        previous, self.presenter = self.presenter, peer
+        logger.info("BROADCAST {name}: presenter is now {session}".format(name=self.name, session=session))
+        if previous is not None:
+            await previous.release()
+        return sdp_answer[1]
+
+    async def admit(self, session, send, sdp_offer: str) -> str:
+        future = asyncio.get_event_loop().create_future()
+        self.__admissions.append((session, send, sdp_offer, future))
+        self.__admission_pending.set()
+        return await future
+
+    async def __admit_batches(self):
+        while True:
+            await self.__admission_pending.wait()
+            # let a burst of joins pile up, then set them up concurrently
+            await asyncio.sleep(self.batch_window)
+
+            batch = []
+            while self.__admissions and len(batch) < self.max_batch:
+                batch.append(self.__admissions.popleft())
+            if not self.__admissions:
+                self.__admission_pending.clear()
+
+            logger.debug("BROADCAST {name}: admitting {count} viewers".format(name=self.name, count=len(batch)))
+            results = await asyncio.gather(*[self.__admit(session, send, sdp_offer)
+                                             for session, send, sdp_offer, _ in batch], return_exceptions=True)
+            for (_, _, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+            if len(self.__pool) + self.__warming < self.pool_size:
+                prewarming = asyncio.ensure_future(self.prewarm(self.pool_size))
+                self.__prewarming.add(prewarming)
+                prewarming.add_done_callback(self.__prewarming.discard)
+
+    async def __admit(self, session, send, sdp_offer: str) -> str:
+        peer = self.__pool.pop() if self.__pool else await self.__create_peer()
+        peer.attach(session, send)
+        previous, self.viewers[session] = self.viewers.get(session), peer
+        if previous is not None:
+            # a viewer that sends a new offer gets a new endpoint, the old one goes
+            await previous.release()
+        try:
+            async with self.__semaphore:
+                sdp_answer = await peer.endpoint.process_offer(sdp_offer)
+        except Exception:
+            if self.viewers.get(session) is peer:
+                del self.viewers[session]
+            await peer.release()
+            raise
+        return sdp_answer[1]
+
+    def get_peer(self, session) -> BroadcastPeer:
+        if self.presenter is not None and self.presenter.session is session:
+            return self.presenter
+        return self.viewers.get(session)
+
+    async def gather_candidates(self, session):
+        peer = self.get_peer(session)
+        if peer is not None:
+            await peer.endpoint.gather_candidates()
+
+    async def add_candidate(self, session, candidate):
+        peer = self.get_peer(session)
+        if peer is not None:
+            await peer.endpoint.add_ice_candidate(candidate)
+
+    async def remove(self, session):
+        if self.presenter is not None and self.presenter.session is session:
+            presenter, self.presenter = self.presenter, None
+            await self.dispatcher.remove_source()
+            await presenter.release()
+            logger.info("BROADCAST {name}: presenter left".format(name=self.name))
+            return
+
+        viewer = self.viewers.pop(session, None)
+        if viewer is not None:
+            await viewer.release()
+
+    async def close(self):
+        if self.__worker is not None:
+            self.__worker.cancel()
+        for prewarming in list(self.__prewarming):
+            prewarming.cancel()
+        for session, _, _, future in self.__admissions:
+            future.cancel()
+        self.__admissions.clear()
+
+        peers = list(self.viewers.values()) + self.__pool
+        if self.presenter is not None:
+            peers.append(self.presenter)
+        for peer in peers:
+            await peer.release()
+        self.viewers.clear()
+        self.__pool = []
+        self.presenter = None
+
+        await self.dispatcher.release()
+        await self.pipeline.release()
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import logging
+import tornado.web
+
+from abc import ABC
+from tornado import websocket
+from broadcast.broadcast import Broadcast
+from pykurento.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastHandler(tornado.web.RequestHandler):
+    async def get(self):
+        await self.render("broadcast.html")
+
+
+class BroadcastWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
+    broadcast = None
+    # concurrent first joins share one pipeline and Broadcast
+    creating = SingleFlight()
+
+    def open(self):
+        logger.debug("BROADCAST: connection opened")
+
+    async def get_broadcast(self) -> Broadcast:
+        if BroadcastWebSocketHandler.broadcast is None:
+            await self.creating.do("webinar", self.__create_broadcast)
+        return BroadcastWebSocketHandler.broadcast
+
+    async def __create_broadcast(self):
+        if BroadcastWebSocketHandler.broadcast is not None:
+            return
+        pipeline = await self.application.kurento.create_pipeline()
+        broadcast = Broadcast("webinar", pipeline, pool_size=20)
+        try:
+            await broadcast.create()
+        except Exception:
+            await pipeline.release()
+            raise
+        BroadcastWebSocketHandler.broadcast = broadcast
+
+    async def send_message(self, message: dict):
+        await self.write_message(json.dumps(message))
+
+    async def on_message(self, message):
+        pack = json.loads(message)
+        _id = pack["id"]
+
+        if _id in ("presenter", "viewer"):
+            broadcast = await self.get_broadcast()
+            try:
+                if _id == "presenter":
+                    sdp_answer = await broadcast.set_presenter(self, self.send_message, pack["sdpOffer"])
+                else:
+                    sdp_answer = await broadcast.admit(self, self.send_message, pack["sdpOffer"])
+            except Exception as e:
+                logger.error("BROADCAST: could not set up {role}: {e}".format(role=_id, e=e))
+                await self.send_message(dict(id=_id + "Response", response="rejected", message=str(e)))
+                return
+
+            await self.send_message(dict(id=_id + "Response", response="accepted", sdpAnswer=sdp_answer))
+            await broadcast.gather_candidates(self)
+
+        elif _id == "onIceCandidate":
+            if self.broadcast is not None and pack.get('candidate', {'candidate': ''}).get('candidate'):
+                await self.broadcast.add_candidate(self, pack['candidate'])
+
+        elif _id == "stop":
+            if self.broadcast is not None:
+                await self.broadcast.remove(self)
+
+        else:
+            logger.error("BROADCAST: invalid message {message}".format(message=pack))
+
+    def on_close(self):
+        if self.broadcast is not None:
+            asyncio.ensure_future(self.broadcast.remove(self))
+
+    def check_origin(self, origin):
+        return True
@@ -6,6 +6,8 @@ from pykurento import media, KurentoClient
 from tornado import websocket
 import json
 
+from signalling import IceCandidateBatcher
+
 class LoopbackHandler(tornado.web.RequestHandler):
 
   async def get(self):
@@ -25,6 +27,8 @@ class LoopbackWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
         print("open")
 
         self.users.add(self)
+        self.candidates = IceCandidateBatcher(lambda msg: self.broadcast_message(json.dumps(msg)),
+                                              overflow=lambda name: self.close(1008, "Slow consumer"))
 
     async def broadcast_message(self, msg=None, ignore_sender=True):
         for user in self.users:
@@ -42,6 +46,8 @@ class LoopbackWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
             wrtc = await media.WebRtcEndpoint(parent=pipeline)
             await wrtc.on_ice_candidate_found_event(self.ice_candidate_found_event, session=self,
                                          name='javad')
+            await wrtc.on_ice_gathering_done_event(self.ice_gathering_done_event, session=self,
+                                         name='javad')
             # face = media.FaceOverlayFilter(pipeline)
             # face.set_overlayed_image(
             #     "https://github.com/minervaproject/pykurento/blob/master/examples/static/img/rainbowpox.png",
@@ -122,6 +128,7 @@ class LoopbackWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
     def on_close(self):
         print("close")
         self.users.remove(self)
+        self.candidates.discard()
 
     def check_origin(self, origin):
 
@@ -133,9 +140,11 @@ class LoopbackWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
     #     print(args)
     #     print(kwargs)
 
-    async def ice_candidate_found_event(self, *args, **kwargs):
-        res = dict(id="iceCandidate", candidate=args[0]['data']['candidate'])
-        await args[2].broadcast_message(json.dumps(res))
+    async def ice_candidate_found_event(self, event, endpoint, session, name):
+        session.candidates.add(name, event.candidate)
+
+    async def ice_gathering_done_event(self, event, endpoint, session, name):
+        await session.candidates.flush(name)
 
     def get_kurento_client(self):
         if self.application.kurento.get_transport().connection.open:
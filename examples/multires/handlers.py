@@ -1,40 +1,48 @@
 import tornado.web
 from pykurento import media
+from pykurento.layers import LayerCache, LayerManager
+from pykurento.stats import StatsSampler
 
 
 class MultiResHandler(tornado.web.RequestHandler):
-    low_res = None
-    med_res = None
-    high_res = None
+    stats = StatsSampler(interval=2)
+    # transcoding filters are shared by every viewer of the same source and resolution
+    layer_cache = LayerCache()
+    layers = None
     incoming = None
+    pipeline = None
 
     async def get(self):
         res = self.get_argument("res", None)
         if res and MultiResHandler.incoming:
-            if res == "high":
-                MultiResHandler.high_res.connect(MultiResHandler.incoming)
-            elif res == "med":
-                MultiResHandler.med_res.connect(MultiResHandler.incoming)
-            elif res == "low":
-                MultiResHandler.low_res.connect(MultiResHandler.incoming)
+            if res == "auto":
+                await MultiResHandler.layers.pin(MultiResHandler.incoming, None)
+            elif res in ("high", "med", "low"):
+                await MultiResHandler.layers.pin(MultiResHandler.incoming, res)
         else:
             await self.render("multires.html")
 
     async def post(self):
-        sdp_offer = self.request.body
-        pipeline = self.application.kurento.create_pipeline()
-        MultiResHandler.incoming = media.WebRtcEndpoint(pipeline)
-        MultiResHandler.high_res = MultiResHandler.incoming
-        MultiResHandler.low_res = media.GStreamerFilter(pipeline,
-                                                        command="capsfilter caps=video/x-raw,width=160,height=120",
-                                                        filterType="VIDEO")
-        MultiResHandler.med_res = media.GStreamerFilter(pipeline,
-                                                        command="capsfilter caps=video/x-raw,width=320,height=240",
-                                                        filterType="VIDEO")
-
-        sdp_answer = MultiResHandler.incoming.process_offer(sdp_offer)
-        await self.finish(str(sdp_answer))
-
-        await MultiResHandler.high_res.connect(MultiResHandler.incoming)
-        await MultiResHandler.incoming.connect(MultiResHandler.low_res)
-        await MultiResHandler.incoming.connect(MultiResHandler.med_res)
+        sdp_offer = self.request.body.decode()
+        # a new offer replaces the previous call
+        if MultiResHandler.layers is not None:
+            layers, MultiResHandler.layers = MultiResHandler.layers, None
+            await layers.release()
+        if MultiResHandler.pipeline is not None:
+            pipeline, MultiResHandler.pipeline = MultiResHandler.pipeline, None
+            MultiResHandler.incoming = None
+            await pipeline.release()
+
+        pipeline = MultiResHandler.pipeline = await self.application.kurento.create_pipeline()
+        MultiResHandler.incoming = await media.WebRtcEndpoint(pipeline)
+
+        # viewers start on the lowest layer and move up as their bandwidth allows
+        MultiResHandler.layers = LayerManager(MultiResHandler.incoming, MultiResHandler.stats,
+                                              cache=MultiResHandler.layer_cache)
+
+        sdp_answer = await MultiResHandler.incoming.process_offer(sdp_offer)
+        await self.finish(str(sdp_answer[1]))
+
+        await MultiResHandler.layers.add_viewer(MultiResHandler.incoming)
+        MultiResHandler.stats.start()
+        MultiResHandler.layers.start()
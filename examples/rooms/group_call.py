@@ -0,0 +1,110 @@
+import json
+import logging
+
+from rooms.room import ParticipantExists
+from rooms.room_manager import RoomManager, ServerSaturated
+from rooms.user_registry import UserRegistry
+from rooms.user_session import UserSession
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCall:
+    '''
+        Group call signalling, independent of how browsers are connected
+
+        A session is anything with write_message(text) and close(code, reason), such as a
+        tornado websocket handler or a sharding.RemoteSession.
+    '''
+
+    def __init__(self, kurento, stats=None, mcu_threshold=None, state=None, server_load=None):
+        self.kurento = kurento
+        self.room_manager = RoomManager(stats=stats, mcu_threshold=mcu_threshold, state=state,
+                                        server_load=server_load)
+        self.registry = UserRegistry()
+        # sessions in the middle of joinRoom, and those of them whose socket closed meanwhile
+        self.__joining = set()
+        self.__closed_while_joining = set()
+
+    async def restore(self):
+        '''Takes back the rooms recorded in the state backend, e.g. after a restart; call once connected'''
+        await self.room_manager.restore(self.kurento)
+
+    async def on_message(self, session, pack: dict):
+        user: UserSession = self.registry.get_by_session(session)
+
+        if user is not None:
+            logger.debug("Incoming message from user '{name}': {message}".format(name=user.get_name(), message=pack))
+        else:
+            logger.debug("Incoming message from new user: {message}".format(message=pack))
+
+        _id = pack["id"]
+
+        if _id == "joinRoom":
+            await self.join_room(pack, session)
+
+        elif _id == "receiveVideoFrom":
+            sender_name = pack['sender']
+            sender = self.registry.get_by_name(sender_name)
+            sdp_offer = pack['sdpOffer']
+            await user.receive_video_from(sender, sdp_offer)
+
+        elif _id == "leaveRoom":
+            if user:
+                await self.leave_room(user)
+
+        elif _id == "onIceCandidate":
+            if user:
+                # add ice candidate
+                if pack.get('candidate', {'candidate': ''}).get('candidate'):
+                    await user.add_candidate(pack['candidate'], pack.get('name'))
+
+        else:
+            # error
+            logger.error("error")
+
+    async def on_close(self, session):
+        user = self.registry.get_by_session(session)
+        if user is not None:
+            await self.leave_room(user)
+        elif session in self.__joining:
+            # not registered yet, the join leaves again once it is done
+            self.__closed_while_joining.add(session)
+
+    async def join_room(self, params: dict, session):
+        room_name = params['room']
+        name = params['name']
+        logger.info("PARTICIPANT {name}: trying to join room {room_name}".format(name=name, room_name=room_name))
+
+        try:
+            room = await self.room_manager.get_room(room_name, self.kurento)
+        except ServerSaturated:
+            await session.write_message(json.dumps(dict(id="joinRejected", room=room_name, reason="busy")))
+            return
+        self.__joining.add(session)
+        try:
+            user = await room.join(name, session, resume=params.get('resume', False))
+        except ParticipantExists:
+            self.__closed_while_joining.discard(session)
+            await session.write_message(json.dumps(dict(id="joinRejected", room=room_name, reason="name taken")))
+            return
+        except Exception:
+            self.__closed_while_joining.discard(session)
+            # a room created for this join would otherwise never be swept
+            self.room_manager.mark_idle(room)
+            raise
+        finally:
+            self.__joining.discard(session)
+
+        self.registry.register(user)
+        if session in self.__closed_while_joining:
+            self.__closed_while_joining.discard(session)
+            await self.leave_room(user)
+
+    async def leave_room(self, user: UserSession):
+        self.registry.remove_by_session(user.get_session())
+        try:
+            await self.room_manager.leave_room(user)
+        except Exception as e:
+            logger.error("PARTICIPANT {name}: error while leaving room {room_name}: {e}".format(
+                name=user.get_name(), room_name=user.get_room_name(), e=e))
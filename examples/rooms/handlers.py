@@ -1,3 +1,4 @@
+import asyncio
 import json
 import tornado.web
 import logging
@@ -5,9 +6,8 @@ import logging
 from abc import ABC
 from tornado import websocket
 from pykurento import KurentoClient
-from rooms.room_manager import RoomManager
-from rooms.user_registry import UserRegistry
-from rooms.user_session import UserSession
+from pykurento.stats import StatsSampler
+from rooms.group_call import GroupCall
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +19,23 @@ class RoomIndexHandler(tornado.web.RequestHandler):
 
 class GroupCallWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
 
-    room_manager = RoomManager()
-    registry = UserRegistry()
+    stats = StatsSampler()
+    # set to a ServerLoadSampler to refuse new rooms while the media server is saturated
+    server_load = None
+    # set to a shared rooms.state.StateBackend so a restarted instance takes its rooms back
+    state = None
+    group_call = None
+
+    @classmethod
+    def setup(cls, kurento) -> GroupCall:
+        if cls.group_call is None:
+            # rooms of 6 or more are mixed on KMS instead of meshed
+            cls.group_call = GroupCall(kurento, stats=cls.stats, mcu_threshold=6, state=cls.state,
+                                       server_load=cls.server_load)
+        return cls.group_call
+
+    def get_group_call(self) -> GroupCall:
+        return self.setup(self.application.kurento)
 
     def open(self):
         print("open")
@@ -29,40 +44,10 @@ class GroupCallWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
     async def on_message(self, message):
         # parse json to python object
         pack = json.loads(message)
-
-        user:UserSession = self.registry.get_by_session(self)
-
-        if user is not None:
-            logger.debug("Incoming message from user '{name}': {message}".format(name=user.get_name(), message=pack))
-        else:
-            logger.debug("Incoming message from new user: {message}".format(message=pack))
-
-        _id = pack["id"]
-
-        if _id == "joinRoom":
-            await self.join_room(pack, self)
-
-        elif _id == "receiveVideoFrom":
-            sender_name = pack['sender']
-            sender = self.registry.get_by_name(sender_name)
-            sdp_offer = pack['sdpOffer']
-            await user.receive_video_from(sender, sdp_offer)
-
-        elif _id == "leaveRoom":
-            pass
-
-        elif _id == "onIceCandidate":
-            if user:
-                # add ice candidate
-                if pack.get('candidate', {'candidate': ''}).get('candidate'):
-                    await user.add_candidate(pack['candidate'], pack.get('name'))
-
-        else:
-            # error
-            logger.error("error")
+        await self.get_group_call().on_message(self, pack)
 
     def on_close(self):
-        print("close")
+        asyncio.ensure_future(self.get_group_call().on_close(self))
 
 
     def check_origin(self, origin):
@@ -71,7 +56,7 @@ class GroupCallWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
 
     async def ice_candidate_found_event(self, *args, **kwargs):
         print('ice found from server and send to client ', kwargs)
-        res = dict(id="iceCandidate", name=kwargs['name'], candidate=args[0]['data']['candidate'])
+        res = dict(id="iceCandidate", name=kwargs['name'], candidate=args[0].candidate)
         await kwargs['session'].write_message(json.dumps(res))
 
     def get_kurento_client(self):
@@ -79,17 +64,3 @@ class GroupCallWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
             return self.application.kurento
         else:
             return KurentoClient(url="wss://jitsimk.ir/kurento")
-
-    async def join_room(self, params:dict, session:'GroupCallWebSocketHandler'):
-        room_name = params['room']
-        name = params['name']
-        logger.info("PARTICIPANT {name}: trying to join room {room_name}".format(name=name, room_name=room_name))
-
-        room = await self.room_manager.get_room(room_name, self.application.kurento)
-        user = await room.join(name, session)
-        self.registry.register(user)
-
-
-
-
-
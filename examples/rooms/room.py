@@ -1,38 +1,176 @@
+import asyncio
+import json
 import logging
 
+from pykurento import media
 from pykurento.media import MediaPipeline
 from rooms.user_session import UserSession
 
 logger = logging.getLogger(__name__)
 
 
+class RoomMode:
+    # every participant receives every other one through its own WebRtcEndpoint
+    SFU = "sfu"
+    # every participant sends to and receives from a Composite mixer through one endpoint
+    MCU = "mcu"
+
+
+class ParticipantExists(Exception):
+    '''Someone in the room already goes by the name asked for'''
+
+
 class Room:
-    def __init__(self, room_name: str, pipeline: MediaPipeline):
+    def __init__(self, room_name: str, pipeline: MediaPipeline, stats=None, mcu_threshold=None, sfu_threshold=None,
+                 state=None):
         self.__participants = {}
         self.__pipeline = pipeline
         self.__name = room_name
+        self.__stats = stats
+        # names being joined, so two joins under one name can't both get in
+        self.__joining = set()
+        self.__state = state
+
+        # switch to MCU once the room has mcu_threshold participants, back to SFU at sfu_threshold
+        self.__mode = RoomMode.SFU
+        self.__composite = None
+        self.mcu_threshold = mcu_threshold
+        if sfu_threshold is None and mcu_threshold is not None:
+            sfu_threshold = mcu_threshold // 2
+        self.sfu_threshold = sfu_threshold
 
 
     def get_name(self):
         return self.__name
 
+    def get_mode(self):
+        return self.__mode
+
+    def describe(self) -> dict:
+        return dict(
+            pipeline=self.__pipeline.id,
+            mode=self.__mode,
+            composite=self.__composite.id if self.__composite is not None else None
+        )
+
+    async def persist(self):
+        if self.__state is not None:
+            await self.__state.save_room(self.__name, self.describe())
+
+    async def restore(self, record: dict, participants: dict):
+        '''Rebuilds proxies for a room recorded by another node; participants wait for their browsers'''
+        self.__mode = record['mode']
+        if record.get('composite'):
+            self.__composite = await media.Composite(self.__pipeline, id=record['composite'])
+
+        for name, participant_record in participants.items():
+            participant = await UserSession(name=name, room_name=self.__name, session=None, pipeline=self.__pipeline,
+                                            stats=self.__stats, state=self.__state, record=participant_record,
+                                            composite=self.__composite)
+            await participant.create()
+            self.__participants[name] = participant
+
+        logger.info("ROOM {room_name}: restored with {count} participants".format(room_name=self.__name,
+                                                                                count=len(participants)))
+
     async def shutdown(self):
         await self.close()
 
-    async def join(self, user_name: str, session):
+    async def join(self, user_name: str, session, resume=False):
+        '''Adds a participant; with resume, a browser that kept its peers takes back a restored participant'''
+        participant = self.__participants.get(user_name)
+        if user_name in self.__joining or (participant is not None and participant.get_session() is not None):
+            # replacing the participant would leave its endpoints and its browser behind
+            raise ParticipantExists(user_name)
         logger.info("ROOM {room_name}: adding participant {name}".format(room_name=self.__name, name=user_name))
 
-        participant = await UserSession(name=user_name, room_name=self.__name, session=session, pipeline=self.__pipeline)
-        await participant.create()
+        self.__joining.add(user_name)
+        try:
+            if participant is not None:
+                if resume:
+                    logger.info("ROOM {room_name}: participant {name} is back".format(room_name=self.__name,
+                                                                                      name=user_name))
+                    participant.attach(session)
+                    await participant.send_message(dict(
+                        id="sessionResumed",
+                        mode=self.__mode,
+                        data=[other.get_name() for other in self.get_participants() if other != participant]
+                    ))
+                    return participant
+                # a new page can't take over endpoints negotiated by the old one, start it over
+                await self.leave(participant)
+
+            participant = await UserSession(name=user_name, room_name=self.__name, session=session,
+                                            pipeline=self.__pipeline, stats=self.__stats, state=self.__state)
+            try:
+                await participant.create()
+                if self.__mode == RoomMode.MCU:
+                    await participant.use_mixer(self.__composite)
+            except Exception:
+                await participant.close()
+                raise
+        finally:
+            self.__joining.discard(user_name)
         await self.join_room(participant)
         self.__participants.update({participant.get_name(): participant})
-        await self.send_participant_names(participant)
+        # a mode switch already sends every participant the names of the others
+        if not await self.update_mode():
+            await self.send_participant_names(participant)
         return participant
 
-    def leave(self, user: UserSession):
+    async def update_mode(self) -> bool:
+        count = len(self.__participants)
+        if self.__mode == RoomMode.SFU and self.mcu_threshold is not None and count >= self.mcu_threshold:
+            await self.switch_mode(RoomMode.MCU)
+            return True
+        if self.__mode == RoomMode.MCU and count <= self.sfu_threshold:
+            await self.switch_mode(RoomMode.SFU)
+            return True
+        return False
+
+    async def switch_mode(self, mode: str):
+        logger.info("ROOM {room_name}: switching from {old} to {new} with {count} participants".format(
+            room_name=self.__name, old=self.__mode, new=mode, count=len(self.__participants)))
+
+        participants = self.get_participants()
+        if mode == RoomMode.MCU:
+            self.__composite = await media.Composite(self.__pipeline)
+            await asyncio.gather(*[participant.use_mixer(self.__composite) for participant in participants])
+        else:
+            await asyncio.gather(*[participant.leave_mixer() for participant in participants])
+            composite, self.__composite = self.__composite, None
+            await composite.release()
+
+        self.__mode = mode
+        await self.persist()
+        for participant in participants:
+            # each participant gets a different list, so this one can't be broadcast
+            await participant.send_message(dict(
+                id="roomMode",
+                mode=mode,
+                data=[other.get_name() for other in participants if other != participant]
+            ))
+
+    def broadcast(self, message: dict, exclude: UserSession = None) -> list:
+        '''
+            Queues one serialisation of message to every participant but exclude, without
+            waiting on any socket; returns the names of participants that could not take it
+        '''
+        text = json.dumps(message)
+        unnotified = []
+        for participant in self.__participants.values():
+            if participant is exclude:
+                continue
+            if not participant.send_serialized(text):
+                unnotified.append(participant.get_name())
+        return unnotified
+
+    async def leave(self, user: UserSession):
         logger.info("PARTICIPANT {name}: Leaving room {room_name}".format(name=user.get_name(), room_name=self.__name))
-        self.remove_participant(user.get_name())
-        user.close()
+        await self.remove_participant(user.get_name())
+        await user.close()
+        if self.__participants:
+            await self.update_mode()
 
     async def join_room(self, new_participant: UserSession):
         new_participant_msg = dict(
@@ -40,46 +178,45 @@ class Room:
             name=new_participant.get_name()
         )
 
-        participant_list = []
         logger.debug("ROOM {room_name}: notifying other participants of new participant {name}".format(
             room_name=self.__name,
             name=new_participant.get_name()
         ))
         # خبر دادن به بقیه که یک نفر جدید اومد توی گروه
-        for participant in self.__participants.values():
-            try:
-                await participant.send_message(new_participant_msg)
-            except Exception as e:
-                logger.debug("ROOM {room_name}: participant {name} could not be notified, {e}".format(
-                    room_name=self.__name,
-                    name=new_participant.get_name(),
-                    e=e
-                ))
-            participant_list.append(participant.get_name())
+        unnotified_participants = self.broadcast(new_participant_msg, exclude=new_participant)
+        if unnotified_participants:
+            logger.debug("ROOM {room_name}: participants {users} could not be notified of {name}".format(
+                room_name=self.__name,
+                users=unnotified_participants,
+                name=new_participant.get_name()
+            ))
 
-        return participant_list
+        return [participant.get_name() for participant in self.__participants.values()
+                if participant is not new_participant]
 
-    def remove_participant(self, name: str):
-        self.__participants.__delitem__(name)
+    async def remove_participant(self, name: str):
+        self.__participants.pop(name, None)
+        if self.__state is not None:
+            await self.__state.remove_participant(self.__name, name)
 
         logger.debug("ROOM {room_name}: notify all users that {name} is leaving the room".format(
             room_name=self.__name,
             name=name
         ))
 
-        unnotified_participants = []
-
         participant_left = dict(
             id='participantLeft',
             name=name
         )
+        unnotified_participants = self.broadcast(participant_left)
 
-        for participant in self.__participants.values():
-            try:
-                participant.cancel_video_from(name)
-                participant.send_message(participant_left)
-            except Exception as e:
-                unnotified_participants.append(participant.get_name())
+        participants = self.get_participants()
+        results = await asyncio.gather(*[participant.cancel_video_from(name) for participant in participants],
+                                       return_exceptions=True)
+        for participant, result in zip(participants, results):
+            if isinstance(result, Exception):
+                logger.debug("ROOM {room_name}: {user} could not release its endpoint for {name}: {e}".format(
+                    room_name=self.__name, user=participant.get_name(), name=name, e=result))
 
         if unnotified_participants:
             logger.debug("ROOM {room_name}: The users {users} could not be notified that {name} left the room".format(
@@ -98,6 +235,7 @@ class Room:
 
         existing_participants_msg = dict(
             id="existingParticipants",
+            mode=self.__mode,
             data=participants_array
         )
 
@@ -108,6 +246,10 @@ class Room:
         # خبر دادن به کاربر ک چه کسایی هستن توی این گروه
         await user.send_message(existing_participants_msg)
 
+    def is_empty(self) -> bool:
+        # restored participants whose browser never came back don't keep the room alive
+        return not any(participant.get_session() is not None for participant in self.__participants.values())
+
     def get_participants(self) -> list:
         return list(self.__participants.values())
 
@@ -126,6 +268,10 @@ class Room:
 
         self.__participants.clear()
 
+        if self.__composite is not None:
+            composite, self.__composite = self.__composite, None
+            await composite.release()
+
         await self.__pipeline.release()
 
         logger.debug("ROOM {room_name}: closed".format(room_name=self.__name))
@@ -1,36 +1,166 @@
+import asyncio
 import logging
+import time
 
 from pykurento import KurentoClient
+from pykurento.singleflight import SingleFlight
 from rooms.room import Room
+from rooms.state import MemoryStateBackend
 
 logger = logging.getLogger(__name__)
 
 
+class ServerSaturated(Exception):
+    '''Raised instead of creating a room on a media server that is already saturated'''
+
+
 class RoomManager:
-    def __init__(self):
+    def __init__(self, stats=None, mcu_threshold=None, idle_timeout=60, sweep_interval=10, state=None,
+                 server_load=None, reattach_timeout=30):
 
         self.__kurento_client = None
+        self.__stats = stats
+        self.__mcu_threshold = mcu_threshold
+        self.state = state if state is not None else MemoryStateBackend()
+        # a pykurento.stats.ServerLoadSampler; new rooms are refused while it reports saturation
+        self.server_load = server_load
 
         self.__rooms = {}
+        # concurrent joins of a new room share one pipeline creation
+        self.__creating = SingleFlight()
+
+        # empty rooms are closed, releasing their pipeline, once idle for idle_timeout seconds
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.__idle_since = {}
+        self.__sweeper = None
+        # restored participants whose browser doesn't come back within reattach_timeout seconds leave
+        self.reattach_timeout = reattach_timeout
 
 
     async def get_room(self, room_name: str, kurento):
         self.__kurento_client = kurento
+        self.__ensure_sweeper()
         logger.debug("Searching for room {}".format(room_name))
         room = self.__rooms.get(room_name, None)
 
         if room is None:
-            logger.debug("Room {} not existent. Will create now!".format(room_name))
-            pipeline = await self.__kurento_client.create_pipeline()
-            room = Room(room_name, pipeline)
-            self.__rooms[room_name] = room
-
-            logger.info("ROOM {room_name} has been created".format(room_name=room_name))
+            room = await self.__creating.do(room_name, self.__create_room, room_name)
 
+        self.__idle_since.pop(room_name, None)
         logger.debug("Room {} found!".format(room_name))
         return room
 
+    async def __create_room(self, room_name: str) -> Room:
+        logger.debug("Room {} not existent. Will create now!".format(room_name))
+        if self.server_load is not None and self.server_load.saturated():
+            logger.warning("ROOM {room_name} not created, media server load is {load}".format(
+                room_name=room_name, load=self.server_load.load))
+            raise ServerSaturated(room_name)
+        pipeline = await self.__kurento_client.create_pipeline()
+        room = Room(room_name, pipeline, stats=self.__stats, mcu_threshold=self.__mcu_threshold, state=self.state)
+        self.__rooms[room_name] = room
+        await room.persist()
+
+        logger.info("ROOM {room_name} has been created".format(room_name=room_name))
+        return room
+
+    async def restore(self, kurento):
+        '''
+            Rebuilds the rooms recorded in the state backend that this node doesn't know,
+            e.g. after a restart, from their KMS object ids
+        '''
+        self.__kurento_client = kurento
+        self.__ensure_sweeper()
+        for room_name, record in (await self.state.get_rooms()).items():
+            if room_name in self.__rooms:
+                continue
+            try:
+                pipeline = await kurento.get_pipeline(record['pipeline'])
+                if kurento.leases is not None:
+                    # this node owns the room now, keep the pipeline from being reaped
+                    await kurento.leases.track(pipeline)
+                room = Room(room_name, pipeline, stats=self.__stats, mcu_threshold=self.__mcu_threshold,
+                            state=self.state)
+                await room.restore(record, await self.state.get_participants(room_name))
+            except Exception as e:
+                logger.error("ROOM {room_name} could not be restored: {e}".format(room_name=room_name, e=e))
+                continue
+
+            self.__rooms[room_name] = room
+            # closed by the sweeper unless someone reconnects in time
+            self.__idle_since[room_name] = time.monotonic()
+
+    def find_room(self, room_name: str) -> Room:
+        return self.__rooms.get(room_name)
+
+    async def leave_room(self, user):
+        room = self.find_room(user.get_room_name())
+        if room is None:
+            await user.close()
+            return
+
+        await room.leave(user)
+        self.mark_idle(room)
+
+    def mark_idle(self, room: Room):
+        '''Starts the idle timeout of a room nobody is in'''
+        if room.is_empty() and self.__rooms.get(room.get_name()) is room:
+            logger.debug("ROOM {room_name} is empty".format(room_name=room.get_name()))
+            self.__idle_since.setdefault(room.get_name(), time.monotonic())
+
     async def remove_room(self, room: 'Room'):
-        self.__rooms.__delitem__(room.get_name())
+        self.__rooms.pop(room.get_name(), None)
+        self.__idle_since.pop(room.get_name(), None)
+        await self.state.remove_room(room.get_name())
         await room.close()
         logger.info("ROOM {room_name} removed and closed".format(room_name=room.get_name()))
+
+    def __ensure_sweeper(self):
+        if self.__sweeper is None or self.__sweeper.done():
+            self.__sweeper = asyncio.ensure_future(self.__sweep())
+
+    async def __sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("Room sweep failed: {e}".format(e=e))
+
+    async def sweep(self):
+        now = time.monotonic()
+        for room in list(self.__rooms.values()):
+            for participant in room.get_participants():
+                if participant.detached_since is not None and now - participant.detached_since >= self.reattach_timeout:
+                    logger.info("PARTICIPANT {name}: did not come back to room {room_name}".format(
+                        name=participant.get_name(), room_name=room.get_name()))
+                    try:
+                        await self.leave_room(participant)
+                    except Exception as e:
+                        logger.error("PARTICIPANT {name}: error while leaving room {room_name}: {e}".format(
+                            name=participant.get_name(), room_name=room.get_name(), e=e))
+        # rooms left empty on a path that never marked them, e.g. a failed first join, close after
+        # the usual idle timeout
+        for room_name, room in self.__rooms.items():
+            if room_name not in self.__idle_since and room.is_empty():
+                self.__idle_since[room_name] = now
+                logger.debug("ROOM {room_name} found empty".format(room_name=room_name))
+        for room_name, idle_since in list(self.__idle_since.items()):
+            room = self.__rooms.get(room_name)
+            if room is None:
+                self.__idle_since.pop(room_name, None)
+            elif not room.is_empty():
+                # someone joined again in the meantime
+                self.__idle_since.pop(room_name, None)
+            elif now - idle_since >= self.idle_timeout:
+                logger.info("ROOM {room_name} idle for {seconds:.0f}s, closing".format(room_name=room_name,
+                                                                                     seconds=now - idle_since))
+                await self.remove_room(room)
+
+    async def close(self):
+        if self.__sweeper is not None:
+            self.__sweeper.cancel()
+            self.__sweeper = None
+        for room in list(self.__rooms.values()):
+            await self.remove_room(room)
@@ -0,0 +1,146 @@
+import json
+import logging
+
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(ABC):
+    '''
+        Where rooms, their participants and the KMS object ids behind them are recorded
+
+        A room record holds the pipeline id, the room mode and the composite id (MCU only).
+        A participant record holds the ids of its outgoing endpoint, its incoming endpoints
+        by sender name and its hub port (MCU only). With a shared backend another node can
+        rebuild media proxies from these ids, see RoomManager.restore.
+    '''
+
+    @abstractmethod
+    async def save_room(self, room_name: str, record: dict):
+        pass
+
+    @abstractmethod
+    async def remove_room(self, room_name: str):
+        pass
+
+    @abstractmethod
+    async def get_rooms(self) -> dict:
+        pass
+
+    @abstractmethod
+    async def save_participant(self, room_name: str, name: str, record: dict):
+        pass
+
+    @abstractmethod
+    async def remove_participant(self, room_name: str, name: str):
+        pass
+
+    @abstractmethod
+    async def get_participants(self, room_name: str) -> dict:
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    '''Keeps state in this process only; the default'''
+
+    def __init__(self):
+        self.rooms = {}
+        self.participants = {}
+
+    async def save_room(self, room_name: str, record: dict):
+        self.rooms[room_name] = dict(record)
+
+    async def remove_room(self, room_name: str):
+        self.rooms.pop(room_name, None)
+        self.participants.pop(room_name, None)
+
+    async def get_rooms(self) -> dict:
+        return dict(self.rooms)
+
+    async def save_participant(self, room_name: str, name: str, record: dict):
+        self.participants.setdefault(room_name, {})[name] = dict(record)
+
+    async def remove_participant(self, room_name: str, name: str):
+        self.participants.get(room_name, {}).pop(name, None)
+
+    async def get_participants(self, room_name: str) -> dict:
+        return dict(self.participants.get(room_name, {}))
+
+
+class KeyValueStateBackend(StateBackend):
+    '''
+        Keeps state in a shared hash store, so several nodes see the same rooms
+
+        `store` needs the async hset/hget/hdel/hgetall/delete calls of a redis.asyncio
+        client created with decode_responses=True; LocalStore is an in-process stand-in.
+    '''
+
+    def __init__(self, store, prefix="pykurento"):
+        self.store = store
+        self.prefix = prefix
+
+    def __rooms_key(self):
+        return "{prefix}:rooms".format(prefix=self.prefix)
+
+    def __participants_key(self, room_name: str):
+        return "{prefix}:room:{room_name}:participants".format(prefix=self.prefix, room_name=room_name)
+
+    async def save_room(self, room_name: str, record: dict):
+        await self.store.hset(self.__rooms_key(), room_name, json.dumps(record))
+
+    async def remove_room(self, room_name: str):
+        await self.store.hdel(self.__rooms_key(), room_name)
+        await self.store.delete(self.__participants_key(room_name))
+
+    async def get_rooms(self) -> dict:
+        rooms = await self.store.hgetall(self.__rooms_key())
+        return dict((room_name, json.loads(record)) for room_name, record in rooms.items())
+
+    async def save_participant(self, room_name: str, name: str, record: dict):
+        await self.store.hset(self.__participants_key(room_name), name, json.dumps(record))
+
+    async def remove_participant(self, room_name: str, name: str):
+        await self.store.hdel(self.__participants_key(room_name), name)
+
+    async def get_participants(self, room_name: str) -> dict:
+        participants = await self.store.hgetall(self.__participants_key(room_name))
+        return dict((name, json.loads(record)) for name, record in participants.items())
+
+
+class LocalStore:
+    '''The subset of the redis.asyncio hash API used by KeyValueStateBackend, kept in memory'''
+
+    def __init__(self):
+        self.hashes = {}
+
+    async def hset(self, key: str, field: str, value: str):
+        created = field not in self.hashes.get(key, {})
+        self.hashes.setdefault(key, {})[field] = value
+        return int(created)
+
+    async def hget(self, key: str, field: str):
+        return self.hashes.get(key, {}).get(field)
+
+    async def hdel(self, key: str, *fields):
+        values = self.hashes.get(key, {})
+        removed = 0
+        for field in fields:
+            if values.pop(field, None) is not None:
+                removed += 1
+        if key in self.hashes and not values:
+            del self.hashes[key]
+        return removed
+
+    async def hgetall(self, key: str) -> dict:
+        return dict(self.hashes.get(key, {}))
+
+    async def delete(self, *keys):
+        return sum(1 for key in keys if self.hashes.pop(key, None) is not None)
+
+
+def open_state(url: str, prefix="pykurento") -> StateBackend:
+    '''A KeyValueStateBackend on the redis server at url, e.g. redis://localhost:6379/0'''
+    # imported here, redis is only needed when state is shared between nodes
+    import redis.asyncio
+    return KeyValueStateBackend(redis.asyncio.from_url(url, decode_responses=True), prefix=prefix)
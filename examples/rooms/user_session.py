@@ -1,36 +1,90 @@
 import json
 import logging
+import time
 
 from asyncinit import asyncinit
 
 from pykurento import media
 from pykurento.media import MediaPipeline
+from signalling import IceCandidateBatcher, OutboundQueue
 
 
 logger = logging.getLogger(__name__)
 
 @asyncinit
 class UserSession:
-    async def __init__(self, name: str, room_name: str, session, pipeline: MediaPipeline):
+    async def __init__(self, name: str, room_name: str, session, pipeline: MediaPipeline, stats=None, state=None,
+                       record: dict = None, composite: media.Composite = None):
         self.name = name
         self.session = session
 
         self.pipeline = pipeline
 
         self.room_name = room_name
+        self.state = state
 
-        self.__outgoing_media = await media.WebRtcEndpoint(pipeline)
         self.__incoming_media = {}
+        # set while the room is mixed (MCU): outgoing media is connected both ways to this port
+        self.__hub_port = None
+        self.__negotiated = False
+
+        if record is None:
+            self.__outgoing_media = await media.WebRtcEndpoint(pipeline)
+        else:
+            # rebuilding a participant recorded by another node, its media is still alive on KMS
+            self.__outgoing_media = await media.WebRtcEndpoint(pipeline, id=record['outgoing'])
+            for sender_name, endpoint_id in record['incoming'].items():
+                self.__incoming_media[sender_name] = await media.WebRtcEndpoint(pipeline, id=endpoint_id)
+            if record.get('hub_port') and composite is not None:
+                self.__hub_port = await media.HubPort(composite, id=record['hub_port'])
+            self.__negotiated = record.get('negotiated', False)
+
+        self.stats = stats
+        if self.stats is not None:
+            self.stats.register(self.__outgoing_media, room=room_name, participant=name)
+            for incoming in self.__incoming_media.values():
+                self.stats.register(incoming, room=room_name, participant=name)
+
+        # None while a restored participant waits for its browser, messages to it are dropped
+        self.outbound = OutboundQueue(session) if session is not None else None
+        self.detached_since = time.monotonic() if session is None else None
+        self.candidates = IceCandidateBatcher(self.send_message,
+                                              overflow=lambda name: self.session.close(1008, "Slow consumer"))
 
 
     async def create(self):
-        await self.__outgoing_media.on_ice_candidate_found_event(self.ice_candidate_found_event, session=self.session,
-                                                                     name=self.name)
+        await self.subscribe_ice_events(self.__outgoing_media, self.name)
+        for sender_name, incoming in self.__incoming_media.items():
+            await self.subscribe_ice_events(incoming, sender_name)
+        await self.persist()
+
+    def attach(self, session):
+        '''Hands a restored participant over to its reconnected browser'''
+        self.session = session
+        self.outbound = OutboundQueue(session)
+        self.detached_since = None
+
+    def describe(self) -> dict:
+        return dict(
+            outgoing=self.__outgoing_media.id,
+            incoming=dict((sender_name, incoming.id) for sender_name, incoming in self.__incoming_media.items()),
+            hub_port=self.__hub_port.id if self.__hub_port is not None else None,
+            negotiated=self.__negotiated
+        )
+
+    async def persist(self):
+        if self.state is not None:
+            await self.state.save_participant(self.room_name, self.name, self.describe())
 
-    @staticmethod
-    async def ice_candidate_found_event(*args, **kwargs):
-        res = dict(id="iceCandidate", name=args[3], candidate=args[0]['data']['candidate'])
-        await args[2].write_message(json.dumps(res))
+    async def subscribe_ice_events(self, endpoint: media.WebRtcEndpoint, name: str):
+        await endpoint.on_ice_candidate_found_event(self.ice_candidate_found_event, session=self.session, name=name)
+        await endpoint.on_ice_gathering_done_event(self.ice_gathering_done_event, session=self.session, name=name)
+
+    async def ice_candidate_found_event(self, event, endpoint, session, name):
+        self.candidates.add(name, event.candidate)
+
+    async def ice_gathering_done_event(self, event, endpoint, session, name):
+        await self.candidates.flush(name)
 
     def get_outgoing_web_rtc_peer(self) -> media.WebRtcEndpoint:
         return self.__outgoing_media
@@ -44,7 +98,15 @@ class UserSession:
     def get_room_name(self) -> str:
         return self.room_name
 
+    def is_mixed(self) -> bool:
+        return self.__hub_port is not None
+
     async def receive_video_from(self, sender: 'UserSession', sdp_offer: str):
+        if self.is_mixed() and sender.get_name() != self.name:
+            logger.debug("USER {name}: room {room_name} is mixed, not receiving {sender} separately".format(
+                name=self.name, room_name=self.room_name, sender=sender.get_name()))
+            return
+
         logger.info("USER {name}: connecting with {sender} in room {room_name}".format(name=self.name,
                                                                                        sender=sender.get_name(),
                                                                                        room_name=self.room_name))
@@ -54,6 +116,9 @@ class UserSession:
 
         en = await self.get_endpoint_for_user(sender)
         ip_sdp_answer = await en.process_offer(sdp_offer)
+        if en is self.__outgoing_media:
+            self.__negotiated = True
+            await self.persist()
 
         sc_params = dict(
             id="receiveVideoAnswer",
@@ -85,11 +150,13 @@ class UserSession:
 
             incoming = await media.WebRtcEndpoint(parent=self.pipeline)
 
-            await incoming.on_ice_candidate_found_event(self.ice_candidate_found_event, session=self.session,
-                                                      name=sender.get_name())
+            await self.subscribe_ice_events(incoming, sender.get_name())
+            if self.stats is not None:
+                self.stats.register(incoming, room=self.room_name, participant=self.name)
             self.__incoming_media.update({
                 sender.get_name(): incoming
             })
+            await self.persist()
 
         logger.debug("PARTICIPANT {name}: obtained endpoint for {sender}".format(name=self.name,
                                                                                  sender=sender.get_name()))
@@ -100,23 +167,82 @@ class UserSession:
     async def cancel_video_from(self, sender_name: str):
         logger.debug("PARTICIPANT {room_name}: Canceling video reception from {sender}".format(room_name=self.name,
                                                                                                sender=sender_name))
-        incoming = self.__incoming_media.__delitem__(sender_name)
+        incoming = self.__incoming_media.pop(sender_name, None)
+        if incoming is None:
+            return
+        self.candidates.discard(sender_name)
+        if self.stats is not None:
+            self.stats.unregister(incoming)
         logger.debug \
             ("PARTICIPANT {room_name}: Removing endpoint for {sender}".format(room_name=self.name, sender=sender_name))
         await incoming.release()
+        await self.persist()
+
+    async def use_mixer(self, composite: media.Composite):
+        logger.debug("PARTICIPANT {name}: sending and receiving through the room mixer".format(name=self.name))
+        await self.reset_media()
+        self.__hub_port = await composite.create_hub_port()
+        await self.__outgoing_media.connect(self.__hub_port)
+        await self.__hub_port.connect(self.__outgoing_media)
+        await self.persist()
+
+    async def leave_mixer(self):
+        logger.debug("PARTICIPANT {name}: leaving the room mixer".format(name=self.name))
+        await self.reset_media()
+
+    async def reset_media(self):
+        '''
+            Drops incoming endpoints and the mixer port; the outgoing endpoint is replaced
+            if it has already been negotiated, since KMS can't process a second offer on it
+        '''
+        for sender_name in list(self.__incoming_media.keys()):
+            await self.cancel_video_from(sender_name)
+
+        if self.__hub_port is not None:
+            hub_port, self.__hub_port = self.__hub_port, None
+            await hub_port.release()
+
+        if self.__negotiated:
+            self.candidates.discard(self.name)
+            if self.stats is not None:
+                self.stats.unregister(self.__outgoing_media)
+            await self.__outgoing_media.release()
+
+            self.__outgoing_media = await media.WebRtcEndpoint(self.pipeline)
+            self.__negotiated = False
+            if self.stats is not None:
+                self.stats.register(self.__outgoing_media, room=self.room_name, participant=self.name)
+            await self.subscribe_ice_events(self.__outgoing_media, self.name)
+
+        await self.persist()
 
     async def close(self):
         logger.debug("PARTICIPANT {name}: Releasing resources".format(name=self.name))
+        self.candidates.discard()
+        if self.outbound is not None:
+            self.outbound.close()
+        if self.__hub_port is not None:
+            hub_port, self.__hub_port = self.__hub_port, None
+            await hub_port.release()
         for remote_participant_name in self.__incoming_media.keys():
             logger.debug("PARTICIPANT {name}: Released incoming EP for {remote_participant}".format(
                 name=self.name, remote_participant=remote_participant_name))
             ep = self.__incoming_media.get(remote_participant_name)
+            if self.stats is not None:
+                self.stats.unregister(ep)
             await ep.release()
+        if self.stats is not None:
+            self.stats.unregister(self.__outgoing_media)
         await self.__outgoing_media.release()
 
     async def send_message(self, message: dict):
         logger.debug("USER {name}: Sending message {message}".format(name=self.name, message=message))
-        await self.session.write_message(json.dumps(message))
+        self.send_serialized(json.dumps(message))
+
+    def send_serialized(self, text: str) -> bool:
+        if self.outbound is None:
+            return False
+        return self.outbound.put(text)
 
     async def add_candidate(self, candidate, name:str):
         if self.name == name:
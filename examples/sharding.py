@@ -0,0 +1,233 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import uuid
+
+import tornado.websocket
+
+from abc import ABC
+from pykurento import KurentoClient
+from pykurento.reaper import PipelineLeases
+from pykurento.stats import ServerLoadSampler, StatsSampler
+from signalling import OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+# SDP offers travel inside IPC lines, keep the line limit well above their size
+LINE_LIMIT = 2 ** 20
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+class HashRing:
+    '''Consistent hashing of room names onto workers, so adding a worker only moves a share of the rooms'''
+
+    def __init__(self, nodes, replicas=64):
+        self.__ring = sorted((_hash("{node}-{i}".format(node=node, i=i)), node)
+                             for node in nodes for i in range(replicas))
+        self.__keys = [key for key, _ in self.__ring]
+
+    def get(self, key: str):
+        index = bisect.bisect(self.__keys, _hash(key)) % len(self.__ring)
+        return self.__ring[index][1]
+
+
+def _encode(**packet) -> bytes:
+    return (json.dumps(packet) + "\n").encode()
+
+
+# WORKER SIDE
+
+class RemoteSession:
+    '''Stands in for a browser websocket that lives in the front process'''
+
+    def __init__(self, conn: str, writer: asyncio.StreamWriter):
+        self.conn = conn
+        self.writer = writer
+        self.inbox = asyncio.Queue()
+        self.task = None
+
+    async def write_message(self, text: str):
+        self.writer.write(_encode(conn=self.conn, message=text))
+        await self.writer.drain()
+
+    def close(self, code=None, reason=None):
+        self.writer.write(_encode(conn=self.conn, close=[code, reason]))
+
+
+async def serve_worker(index: int, path: str, kurento_url: str):
+    # imported here so the front process doesn't need the rooms example loaded
+    from rooms.group_call import GroupCall
+    from rooms.state import open_state
+
+    leases = PipelineLeases(owner="{host}-{pid}".format(host=socket.gethostname(), pid=os.getpid()))
+    kurento = KurentoClient(url=kurento_url, leases=leases)
+    await kurento.get_transport().connect()
+    leases.start()
+    asyncio.ensure_future(kurento.get_transport().receive_message())
+    asyncio.ensure_future(kurento.get_transport().process_messages())
+
+    stats = StatsSampler()
+    stats.start()
+    server_load = ServerLoadSampler(kurento)
+    server_load.start()
+    # rooms are recorded per worker index, the ring gives a restarted worker the same rooms again
+    state_url = os.environ.get("KURENTO_STATE_URL")
+    state = open_state(state_url, prefix="pykurento:worker{index}".format(index=index)) if state_url else None
+    group_call = GroupCall(kurento, stats=stats, mcu_threshold=6, state=state, server_load=server_load)
+    if state is not None:
+        await group_call.restore()
+
+    async def consume(session: RemoteSession):
+        # messages of one browser are handled in order, different browsers concurrently
+        while True:
+            pack = await session.inbox.get()
+            if pack is None:
+                await group_call.on_close(session)
+                return
+            try:
+                await group_call.on_message(session, pack)
+            except Exception as e:
+                logger.error("WORKER {index}: error handling {message}: {e}".format(index=index, message=pack, e=e))
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sessions = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            packet = json.loads(line)
+            conn = packet["conn"]
+
+            session = sessions.get(conn)
+            if session is None:
+                session = sessions[conn] = RemoteSession(conn, writer)
+                session.task = asyncio.ensure_future(consume(session))
+
+            if packet.get("closed"):
+                del sessions[conn]
+                session.inbox.put_nowait(None)
+            else:
+                session.inbox.put_nowait(json.loads(packet["message"]))
+
+        # the front went away, so did all of its browsers
+        for session in sessions.values():
+            session.inbox.put_nowait(None)
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path=path, limit=LINE_LIMIT)
+    logger.info("WORKER {index}: serving rooms on {path}".format(index=index, path=path))
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(index: int, path: str, kurento_url: str):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve_worker(index, path, kurento_url))
+
+
+def start_workers(count: int, kurento_url: str, socket_dir="/tmp") -> list:
+    '''Spawns count worker processes, each with its own KMS transport; returns their socket paths'''
+    context = multiprocessing.get_context("spawn")
+    paths = []
+    for index in range(count):
+        path = os.path.join(socket_dir, "pykurento-worker-{pid}-{index}.sock".format(pid=os.getpid(), index=index))
+        process = context.Process(target=run_worker, args=(index, path, kurento_url), daemon=True)
+        process.start()
+        paths.append(path)
+    return paths
+
+
+# FRONT SIDE
+
+class WorkerChannel:
+    '''The front process's connection to one worker'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handlers = {}
+        self.writer = None
+
+    async def connect(self, attempts=50, delay=0.1):
+        for _ in range(attempts):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # the worker is still starting
+                await asyncio.sleep(delay)
+        else:
+            raise ConnectionError("Worker at {path} did not come up".format(path=self.path))
+        asyncio.ensure_future(self.__read(reader))
+
+    async def send(self, conn: str, **fields):
+        self.writer.write(_encode(conn=conn, **fields))
+        await self.writer.drain()
+
+    async def __read(self, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                logger.error("Worker at {path} went away".format(path=self.path))
+                for handler in list(self.handlers.values()):
+                    handler.close(1011, "Worker went away")
+                return
+
+            packet = json.loads(line)
+            handler = self.handlers.get(packet["conn"])
+            if handler is None:
+                continue
+            # never wait on a browser here, one slow socket would hold up every browser of the worker
+            if "message" in packet:
+                handler.outbound.put(packet["message"])
+            elif "close" in packet:
+                handler.outbound.close()
+                handler.close(*packet["close"])
+
+
+class ShardedGroupCallWebSocketHandler(tornado.websocket.WebSocketHandler, ABC):
+    '''Routes each browser's group call messages to the worker owning its room'''
+
+    ring = None
+    channels = {}
+
+    @classmethod
+    async def configure(cls, paths: list):
+        for path in paths:
+            channel = WorkerChannel(path)
+            await channel.connect()
+            cls.channels[path] = channel
+        cls.ring = HashRing(paths)
+
+    def open(self):
+        self.conn = uuid.uuid4().hex
+        self.channel = None
+        self.outbound = OutboundQueue(self)
+
+    async def on_message(self, message):
+        if self.channel is None:
+            pack = json.loads(message)
+            if pack.get("id") != "joinRoom":
+                logger.debug("Dropping {message} sent before joining a room".format(message=pack))
+                return
+            self.channel = self.channels[self.ring.get(pack["room"])]
+            self.channel.handlers[self.conn] = self
+
+        await self.channel.send(self.conn, message=message)
+
+    def on_close(self):
+        self.outbound.close()
+        if self.channel is not None:
+            self.channel.handlers.pop(self.conn, None)
+            asyncio.ensure_future(self.channel.send(self.conn, closed=True))
+
+    def check_origin(self, origin):
+        return True
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class IceCandidateBatcher:
+    '''
+        Coalesces ICE candidates found by KMS into batched `iceCandidates` messages
+
+        Candidates are grouped per endpoint name and flushed once `window` seconds have
+        passed since the first pending candidate, as soon as `max_batch` candidates are
+        pending, or when flush() is called on IceGatheringDone. Those found while a batch
+        is being written go out in the next one, at most `max_batch` per message. Dropping
+        a candidate can break connectivity, so once `max_pending` are waiting for a client
+        that doesn't keep up, its pending candidates are discarded and `overflow(name)` is
+        called to end the session instead.
+    '''
+
+    def __init__(self, send, window=0.02, max_batch=16, max_pending=256, overflow=None):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.overflow = overflow
+
+        self.__pending = {}
+        self.__timers = {}
+        self.__flushing = set()
+
+    def add(self, name, candidate) -> bool:
+        pending = self.__pending.get(name)
+        if pending is None:
+            pending = self.__pending[name] = deque()
+        if len(pending) >= self.max_pending:
+            logger.warning("ICE {name}: {count} candidates pending, disconnecting slow client".format(
+                name=name, count=len(pending)))
+            self.discard(name)
+            if self.overflow is not None:
+                self.overflow(name)
+            return False
+        pending.append(candidate)
+
+        if len(pending) >= self.max_batch:
+            self.__schedule(name, 0)
+        elif name not in self.__timers:
+            self.__schedule(name, self.window)
+        return True
+
+    def __schedule(self, name, delay):
+        timer = self.__timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+
+        loop = asyncio.get_event_loop()
+        if delay:
+            self.__timers[name] = loop.call_later(delay, self.__flush_later, name)
+        else:
+            self.__flush_later(name)
+
+    def __flush_later(self, name):
+        asyncio.ensure_future(self.flush(name)).add_done_callback(
+            lambda task: self.__log_failure(name, task))
+
+    def __log_failure(self, name, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("ICE {name}: could not send candidates: {e}".format(name=name, e=task.exception()))
+
+    async def flush(self, name):
+        timer = self.__timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+
+        # a write for this endpoint is still in progress, it will pick up what is pending
+        if name in self.__flushing:
+            return
+
+        self.__flushing.add(name)
+        try:
+            pending = self.__pending.get(name)
+            while pending:
+                candidates = [pending.popleft() for _ in range(min(self.max_batch, len(pending)))]
+                await self.send(dict(id="iceCandidates", name=name, candidates=candidates))
+        finally:
+            self.__flushing.discard(name)
+            if not self.__pending.get(name):
+                self.__pending.pop(name, None)
+
+    async def flush_all(self):
+        for name in list(self.__pending.keys()):
+            await self.flush(name)
+
+    def discard(self, name=None):
+        names = [name] if name is not None else list(self.__pending.keys())
+        for n in names:
+            timer = self.__timers.pop(n, None)
+            if timer is not None:
+                timer.cancel()
+            self.__pending.pop(n, None)
+
+
+class OverflowPolicy:
+    # close the websocket of a client that can't keep up
+    DISCONNECT = "disconnect"
+    # keep the client but drop its oldest queued messages
+    DROP_OLDEST = "drop_oldest"
+
+
+class OutboundQueue:
+    '''
+        Bounded queue of serialised messages written to one browser websocket in order
+
+        Putting never waits on the socket, so a stalled client only ever holds up itself.
+        Once `max_queued` messages are waiting, the client is disconnected or loses its
+        oldest messages depending on `overflow`.
+    '''
+
+    def __init__(self, session, max_queued=256, overflow=OverflowPolicy.DISCONNECT):
+        self.session = session
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.closed = False
+        self.dropped = 0
+
+        self.__queue = deque()
+        self.__writer = None
+
+    def put(self, text: str) -> bool:
+        if self.closed:
+            return False
+
+        if len(self.__queue) >= self.max_queued:
+            if self.overflow == OverflowPolicy.DISCONNECT:
+                logger.warning("OUTBOUND: {count} messages queued, disconnecting slow client".format(
+                    count=len(self.__queue)))
+                self.close()
+                self.session.close(1008, "Slow consumer")
+                return False
+            self.__queue.popleft()
+            self.dropped += 1
+
+        self.__queue.append(text)
+        if self.__writer is None or self.__writer.done():
+            self.__writer = asyncio.ensure_future(self.__write())
+        return True
+
+    async def __write(self):
+        while self.__queue and not self.closed:
+            text = self.__queue.popleft()
+            try:
+                await self.session.write_message(text)
+            except Exception as e:
+                logger.debug("OUTBOUND: client went away, {count} messages not sent: {e}".format(
+                    count=len(self.__queue) + 1, e=e))
+                self.close()
+
+    def close(self):
+        self.closed = True
+        self.__queue.clear()
+
+    def __len__(self):
+        return len(self.__queue)
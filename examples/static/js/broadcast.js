@@ -0,0 +1,103 @@
+var ws = new WebSocket('wss://' + location.host + '/broadcast/websocket');
+var video;
+var webRtcPeer;
+
+window.onload = function() {
+	console = new Console();
+	video = document.getElementById('video');
+}
+
+window.onbeforeunload = function() {
+	ws.close();
+}
+
+ws.onmessage = function(message) {
+	var parsedMessage = JSON.parse(message.data);
+	console.info('Received message: ' + message.data);
+
+	switch (parsedMessage.id) {
+	case 'presenterResponse':
+	case 'viewerResponse':
+		if (parsedMessage.response !== 'accepted') {
+			console.warn('Call not accepted: ' + parsedMessage.message);
+			dispose();
+			return;
+		}
+		webRtcPeer.processAnswer(parsedMessage.sdpAnswer);
+		break;
+	case 'iceCandidates':
+		parsedMessage.candidates.forEach(function(candidate) {
+			webRtcPeer.addIceCandidate(candidate);
+		});
+		break;
+	default:
+		console.error('Unrecognized message', parsedMessage);
+	}
+}
+
+function presenter() {
+	if (webRtcPeer) {
+		return;
+	}
+	var options = {
+		localVideo: video,
+		onicecandidate: onIceCandidate
+	};
+	webRtcPeer = kurentoUtils.WebRtcPeer.WebRtcPeerSendonly(options, function(error) {
+		if (error) return console.error(error);
+		this.generateOffer(onOffer('presenter'));
+	});
+}
+
+function viewer() {
+	if (webRtcPeer) {
+		return;
+	}
+	var options = {
+		remoteVideo: video,
+		onicecandidate: onIceCandidate
+	};
+	webRtcPeer = kurentoUtils.WebRtcPeer.WebRtcPeerRecvonly(options, function(error) {
+		if (error) return console.error(error);
+		this.generateOffer(onOffer('viewer'));
+	});
+}
+
+function onOffer(role) {
+	return function(error, offerSdp) {
+		if (error) return console.error(error);
+		sendMessage({
+			id : role,
+			sdpOffer : offerSdp
+		});
+	};
+}
+
+function onIceCandidate(candidate) {
+	sendMessage({
+		id : 'onIceCandidate',
+		candidate : candidate
+	});
+}
+
+function stop() {
+	if (webRtcPeer) {
+		sendMessage({
+			id : 'stop'
+		});
+		dispose();
+	}
+}
+
+function dispose() {
+	if (webRtcPeer) {
+		webRtcPeer.dispose();
+		webRtcPeer = null;
+	}
+}
+
+function sendMessage(message) {
+	var jsonMessage = JSON.stringify(message);
+	console.log('Sending message: ' + jsonMessage);
+	ws.send(jsonMessage);
+}
@@ -16,15 +16,44 @@
  */
 
 window.onbeforeunload = function () {
+    joined = false;
     ws.close();
 };
 
-ws = new WebSocket('wss://' + location.host + '/groupcall');
+var ws;
 var participants = {};
 var name;
 var room;
+// 'sfu': one peer per participant, 'mcu': a single sendrecv peer with the room mix
+var mode = 'sfu';
+// while in a room a lost connection is retried, resuming the room with the peers we still have
+var joined = false;
 
-ws.onmessage = function (message) {
+function connect() {
+    ws = new WebSocket('wss://' + location.host + '/groupcall');
+    ws.onmessage = onMessage;
+    ws.onclose = function () {
+        if (!joined) {
+            return;
+        }
+        console.warn('Connection lost, reconnecting to room ' + room);
+        setTimeout(function () {
+            connect();
+            ws.onopen = function () {
+                sendMessage({
+                    id: 'joinRoom',
+                    name: name,
+                    room: room,
+                    resume: true
+                });
+            };
+        }, 1000);
+    };
+}
+
+connect();
+
+function onMessage(message) {
     var parsedMessage = JSON.parse(message.data);
     console.info('Received message: ' + message.data);
 
@@ -38,6 +67,15 @@ ws.onmessage = function (message) {
         case 'participantLeft':
             onParticipantLeft(parsedMessage);
             break;
+        case 'roomMode':
+            onRoomMode(parsedMessage);
+            break;
+        case 'sessionResumed':
+            onSessionResumed(parsedMessage);
+            break;
+        case 'joinRejected':
+            onJoinRejected(parsedMessage);
+            break;
         case 'receiveVideoAnswer':
             receiveVideoResponse(parsedMessage);
             break;
@@ -48,10 +86,19 @@ ws.onmessage = function (message) {
                 }
             });
             break;
+        case 'iceCandidates':
+            parsedMessage.candidates.forEach(function (candidate) {
+                participants[parsedMessage.name].rtcPeer.addIceCandidate(candidate, function (error) {
+                    if (error) {
+                        console.error("Error adding candidate: " + error);
+                    }
+                });
+            });
+            break;
         default:
             console.error('Unrecognized message', parsedMessage);
     }
-};
+}
 
 function register() {
     name = document.getElementById('name').value;
@@ -66,6 +113,7 @@ function register() {
         name: name,
         room: room,
     };
+    joined = true;
     sendMessage(message);
 }
 
@@ -75,9 +123,51 @@ function callAkbar(){
 }
 
 function onNewParticipant(request) {
+    if (mode === 'mcu') {
+        return;
+    }
     receiveVideo(request.name);
 }
 
+function onRoomMode(msg) {
+    console.log('Room ' + room + ' switched to ' + msg.mode);
+    onExistingParticipants(msg);
+}
+
+function onSessionResumed(msg) {
+    // the server was restarted, media kept flowing on KMS; only catch up on what changed meanwhile
+    if (!participants[name] || (msg.mode || 'sfu') !== mode) {
+        onExistingParticipants(msg);
+        return;
+    }
+    console.log(name + " resumed room " + room);
+    for (var key in participants) {
+        if (key !== name && msg.data.indexOf(key) < 0) {
+            onParticipantLeft({name: key});
+        }
+    }
+    if (mode === 'sfu') {
+        msg.data.forEach(function (sender) {
+            if (!participants[sender]) {
+                receiveVideo(sender);
+            }
+        });
+    }
+}
+
+function disposeParticipants() {
+    for (var key in participants) {
+        participants[key].dispose();
+    }
+    participants = {};
+}
+
+function onJoinRejected(msg) {
+    alert('Could not join room ' + msg.room + ' (' + msg.reason + ')');
+    document.getElementById('room').style.display = 'none';
+    document.getElementById('join').style.display = 'block';
+}
+
 function receiveVideoResponse(result) {
     participants[result.name].rtcPeer.processAnswer(result.sdpAnswer, function (error) {
         if (error) return console.error(error);
@@ -106,38 +196,48 @@ function onExistingParticipants(msg) {
             }
         }
     };
-    console.log(name + " registered in room " + room);
+    // after a reconnect the server starts us over, drop the peers of the previous connection
+    disposeParticipants();
+    mode = msg.mode || 'sfu';
+    console.log(name + " registered in room " + room + " (" + mode + ")");
     var participant = new Participant(name);
     participants[name] = participant;
     var video = participant.getVideoElement();
 
     var options = {
-        localVideo: video,
         mediaConstraints: constraints,
         onicecandidate: participant.onIceCandidate.bind(participant),
         configuration:{
 			iceServers: [{"urls": "stun:185.211.59.123:3478"}, {"urls": "turn:158.211.59.123:5349", "username": "username1", "credential": "key1"}]
 		}
     };
-    participant.rtcPeer = new kurentoUtils.WebRtcPeer.WebRtcPeerSendonly(options,
-        function (error) {
-            if (error) {
-                return console.error(error);
-            }
-            this.generateOffer(participant.offerToReceiveVideo.bind(participant));
-        });
+    var onPeerCreated = function (error) {
+        if (error) {
+            return console.error(error);
+        }
+        this.generateOffer(participant.offerToReceiveVideo.bind(participant));
+    };
+
+    if (mode === 'mcu') {
+        // the server mixes everyone into our own endpoint
+        options.remoteVideo = video;
+        participant.rtcPeer = new kurentoUtils.WebRtcPeer.WebRtcPeerSendrecv(options, onPeerCreated);
+        return;
+    }
+
+    options.localVideo = video;
+    participant.rtcPeer = new kurentoUtils.WebRtcPeer.WebRtcPeerSendonly(options, onPeerCreated);
 
     msg.data.forEach(receiveVideo);
 }
 
 function leaveRoom() {
+    joined = false;
     sendMessage({
         id: 'leaveRoom'
     });
 
-    for (var key in participants) {
-        participants[key].dispose();
-    }
+    disposeParticipants();
 
     document.getElementById('join').style.display = 'block';
     document.getElementById('room').style.display = 'none';
@@ -54,6 +54,11 @@ ws.onmessage = function(message) {
 	case 'iceCandidate':
 		webRtcPeer.addIceCandidate(parsedMessage.candidate)
 		break;
+	case 'iceCandidates':
+		parsedMessage.candidates.forEach(function(candidate) {
+			webRtcPeer.addIceCandidate(candidate)
+		});
+		break;
 	default:
 		if (state === I_AM_STARTING) {
 			setState(I_CAN_START);
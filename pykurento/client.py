@@ -2,15 +2,23 @@ from pykurento import media
 from pykurento.transport import KurentoTransport
 
 class KurentoClient(object):
-  def __init__(self, url, transport=None):
+  def __init__(self, url, transport=None, leases=None, **kwargs):
     self.url = url
-    self.transport = transport or KurentoTransport(self.url)
+    self.transport = transport or KurentoTransport(self.url, **kwargs)
+    # a pykurento.reaper.PipelineLeases; pipelines created here are tagged as ours and kept alive
+    self.leases = leases
 
   def get_transport(self):
     return self.transport
 
   async def create_pipeline(self):
-    return await media.MediaPipeline(self)
+    pipeline = await media.MediaPipeline(self)
+    if self.leases is not None:
+      await self.leases.track(pipeline)
+    return pipeline
 
   def get_pipeline(self, id):
     return media.MediaPipeline(self, id=id)
+
+  async def get_server_manager(self):
+    return await media.ServerManager(self, id=media.ServerManager.ID)
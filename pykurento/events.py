@@ -0,0 +1,294 @@
+import asyncio
+import logging
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _data_field(key):
+    return property(lambda self: self._value['data'].get(key))
+
+
+class MediaEvent(object):
+    '''
+        A KMS event as delivered to subscribers
+
+        Wraps the `value` of an onEvent notification without copying it; fields are
+        read from the payload on access. Indexing (event['data']) returns the raw payload
+        for handlers written against plain dicts.
+    '''
+    __slots__ = ('_value',)
+
+    event_type = None
+
+    def __init__(self, value):
+        self._value = value
+
+    def __getitem__(self, key):
+        return self._value[key]
+
+    def __repr__(self):
+        return "<%s source=%s>" % (self.__class__.__name__, self.source)
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def data(self):
+        return self._value['data']
+
+    @property
+    def object_id(self):
+        return self._value.get('object')
+
+    type = _data_field('type')
+    source = _data_field('source')
+    tags = _data_field('tags')
+    timestamp = _data_field('timestamp')
+    timestamp_millis = _data_field('timestampMillis')
+
+
+class IceCandidateFound(MediaEvent):
+    __slots__ = ()
+    event_type = "IceCandidateFound"
+    candidate = _data_field('candidate')
+
+
+class IceGatheringDone(MediaEvent):
+    __slots__ = ()
+    event_type = "IceGatheringDone"
+
+
+class IceComponentStateChange(MediaEvent):
+    __slots__ = ()
+    event_type = "IceComponentStateChange"
+    stream_id = _data_field('streamId')
+    component_id = _data_field('componentId')
+    state = _data_field('state')
+
+
+class NewCandidatePairSelected(MediaEvent):
+    __slots__ = ()
+    event_type = "NewCandidatePairSelected"
+    candidate_pair = _data_field('candidatePair')
+
+
+class MediaStateChanged(MediaEvent):
+    __slots__ = ()
+    event_type = "MediaStateChanged"
+    old_state = _data_field('oldState')
+    new_state = _data_field('newState')
+
+
+class ConnectionStateChanged(MediaEvent):
+    __slots__ = ()
+    event_type = "ConnectionStateChanged"
+    old_state = _data_field('oldState')
+    new_state = _data_field('newState')
+
+
+class MediaFlowInStateChange(MediaEvent):
+    __slots__ = ()
+    event_type = "MediaFlowInStateChange"
+    state = _data_field('state')
+    pad_name = _data_field('padName')
+    media_type = _data_field('mediaType')
+
+
+class MediaFlowOutStateChange(MediaFlowInStateChange):
+    __slots__ = ()
+    event_type = "MediaFlowOutStateChange"
+
+
+class MediaTranscodingStateChange(MediaEvent):
+    __slots__ = ()
+    event_type = "MediaTranscodingStateChange"
+    state = _data_field('state')
+    bin_name = _data_field('binName')
+    media_type = _data_field('mediaType')
+
+
+class ElementConnected(MediaEvent):
+    __slots__ = ()
+    event_type = "ElementConnected"
+    sink = _data_field('sink')
+    media_type = _data_field('mediaType')
+
+
+class ElementDisconnected(ElementConnected):
+    __slots__ = ()
+    event_type = "ElementDisconnected"
+
+
+class MediaSessionStarted(MediaEvent):
+    __slots__ = ()
+    event_type = "MediaSessionStarted"
+
+
+class MediaSessionTerminated(MediaEvent):
+    __slots__ = ()
+    event_type = "MediaSessionTerminated"
+
+
+class DataChannelOpen(MediaEvent):
+    __slots__ = ()
+    event_type = "DataChannelOpen"
+    channel_id = _data_field('channelId')
+
+
+class DataChannelClose(DataChannelOpen):
+    __slots__ = ()
+    event_type = "DataChannelClose"
+
+
+class EndOfStream(MediaEvent):
+    __slots__ = ()
+    event_type = "EndOfStream"
+
+
+class CodeFound(MediaEvent):
+    __slots__ = ()
+    event_type = "CodeFound"
+    code_type = _data_field('codeType')
+    code = _data_field('value')
+
+
+class Error(MediaEvent):
+    __slots__ = ()
+    event_type = "Error"
+    description = _data_field('description')
+    error_code = _data_field('errorCode')
+
+
+EVENT_TYPES = dict((cls.event_type, cls) for cls in (
+    IceCandidateFound, IceGatheringDone, IceComponentStateChange, NewCandidatePairSelected,
+    MediaStateChanged, ConnectionStateChanged, MediaFlowInStateChange, MediaFlowOutStateChange,
+    MediaTranscodingStateChange, ElementConnected, ElementDisconnected, MediaSessionStarted,
+    MediaSessionTerminated, DataChannelOpen, DataChannelClose, EndOfStream, CodeFound, Error,
+))
+
+
+def build_event(event_type, value):
+    return EVENT_TYPES.get(event_type, MediaEvent)(value)
+
+
+class OverflowPolicy(object):
+    BLOCK = "BLOCK"
+    DROP_OLDEST = "DROP_OLDEST"
+    DROP_NEWEST = "DROP_NEWEST"
+
+
+class EventStream(object):
+    '''
+        Async iterator over the events of a MediaObject
+
+        Use it as an async context manager so its subscriptions are always removed again:
+
+            async with endpoint.events("MediaStateChanged") as stream:
+                async for event in stream:
+                    ...
+
+        Subscriptions are made lazily when iteration starts and removed by aclose(). Leaving
+        an `async for` loop, by break or by an exception, closes the stream as well, though
+        only once the loop's iterator has been collected. Up to `maxsize` events are buffered;
+        once full, the oldest (DROP_OLDEST, the default) or the newest one (DROP_NEWEST) is
+        dropped. BLOCK makes the transport wait for the consumer instead, which holds up the
+        delivery of every KMS event to every subscriber, so only use it for consumers that
+        keep up.
+    '''
+
+    def __init__(self, media_object, event_types, maxsize=64, overflow=OverflowPolicy.DROP_OLDEST):
+        self.media_object = media_object
+        self.event_types = event_types
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+
+        self.__buffer = deque()
+        self.__readable = asyncio.Event()
+        self.__writable = asyncio.Event()
+        self.__writable.set()
+        self.__subscriptions = []
+        self.__subscribing = None
+        self.__closed = False
+
+    async def __aenter__(self):
+        await self.subscribe()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def __aiter__(self):
+        return self.__iterate()
+
+    async def __iterate(self):
+        # an async generator, so abandoning the loop runs the finally clause and unsubscribes
+        try:
+            await self.subscribe()
+            while True:
+                while not self.__buffer:
+                    if self.__closed:
+                        return
+                    self.__readable.clear()
+                    await self.__readable.wait()
+
+                event = self.__buffer.popleft()
+                self.__writable.set()
+                yield event
+        finally:
+            await self.aclose()
+
+    async def subscribe(self):
+        if self.__subscribing is None:
+            self.__subscribing = asyncio.ensure_future(self.__subscribe())
+        await self.__subscribing
+
+    async def __subscribe(self):
+        for event_type in self.event_types:
+            _, subscription_id = await self.media_object.subscribe(event_type, self.__on_event, None, event_type)
+            self.__subscriptions.append(subscription_id)
+
+    async def __on_event(self, event, media_object, session, name):
+        if self.__closed:
+            return
+
+        if len(self.__buffer) >= self.maxsize:
+            if self.overflow == OverflowPolicy.BLOCK:
+                while len(self.__buffer) >= self.maxsize and not self.__closed:
+                    self.__writable.clear()
+                    await self.__writable.wait()
+                if self.__closed:
+                    return
+            elif self.overflow == OverflowPolicy.DROP_OLDEST:
+                self.__buffer.popleft()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return
+
+        self.__buffer.append(event)
+        self.__readable.set()
+
+    async def aclose(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__buffer.clear()
+        self.__readable.set()
+        self.__writable.set()
+
+        if self.__subscribing is not None:
+            try:
+                await self.__subscribing
+            except Exception as ex:
+                logger.debug("Event stream closed after failed subscription: %s" % ex)
+
+        while self.__subscriptions:
+            subscription_id = self.__subscriptions.pop()
+            try:
+                await self.media_object.unsubscribe(subscription_id)
+            except Exception as ex:
+                logger.warning("Could not unsubscribe %s from %s: %s" % (subscription_id, self.media_object.id, ex))
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+
+from collections import namedtuple
+
+from pykurento import media
+
+logger = logging.getLogger(__name__)
+
+
+# width/height of None means the source itself, without transcoding;
+# min_bitrate is the receive bandwidth (bps) a viewer needs to be moved up to the layer
+Layer = namedtuple("Layer", ["name", "width", "height", "min_bitrate"])
+
+DEFAULT_LADDER = (
+    Layer("low", 160, 120, 0),
+    Layer("med", 320, 240, 300000),
+    Layer("high", None, None, 900000),
+)
+
+
+def capsfilter_command(layer):
+    return "capsfilter caps=video/x-raw,width=%d,height=%d" % (layer.width, layer.height)
+
+
+class LayerCache(object):
+    '''
+        Shares transcoding filters between everyone watching the same source
+
+        A filter is created on the first acquire for a (source, command) pair, connected
+        from the source, and released when the last holder releases it. Concurrent first
+        acquires wait on the same creation.
+    '''
+
+    def __init__(self):
+        self.__layers = {}
+
+    async def __create(self, source, command, filter_type):
+        element = await media.GStreamerFilter(source.get_pipeline(), command=command, filterType=filter_type)
+        try:
+            await source.connect(element)
+        except Exception:
+            await element.release()
+            raise
+        logger.debug("LAYERS: created %s for %s: %s" % (element.id, source.id, command))
+        return element
+
+    async def acquire(self, source, command, filter_type="VIDEO"):
+        key = (source.id, command)
+        entry = self.__layers.get(key)
+        if entry is None:
+            entry = self.__layers[key] = [asyncio.ensure_future(self.__create(source, command, filter_type)), 0]
+        entry[1] += 1
+
+        try:
+            return await asyncio.shield(entry[0])
+        except Exception:
+            entry[1] -= 1
+            if self.__layers.get(key) is entry:
+                del self.__layers[key]
+            raise
+
+    async def release(self, source, command):
+        key = (source.id, command)
+        entry = self.__layers.get(key)
+        if entry is None:
+            return
+
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+
+        del self.__layers[key]
+        element = await entry[0]
+        logger.debug("LAYERS: releasing %s for %s: %s" % (element.id, source.id, command))
+        await element.release()
+
+    def holders(self, source, command):
+        entry = self.__layers.get((source.id, command))
+        return entry[1] if entry is not None else 0
+
+    def __len__(self):
+        return len(self.__layers)
+
+
+class _Viewer(object):
+    __slots__ = ("endpoint", "level", "pinned", "up_votes", "down_votes", "last_sample")
+
+    def __init__(self, endpoint, level):
+        self.endpoint = endpoint
+        self.level = level
+        self.pinned = False
+        self.up_votes = 0
+        self.down_votes = 0
+        self.last_sample = None
+
+
+class LayerManager(object):
+    '''
+        Serves a source endpoint to its viewers through a ladder of resolution layers
+
+        Each viewer is connected to one layer and moved between layers from the REMB bandwidth
+        estimate and loss that `stats` reports for the viewer's endpoint. Without REMB the
+        outbound bitrate can't tell whether a higher layer would fit, since it is capped by
+        the current one; such viewers probe one layer up while they lose nothing and come back
+        down on loss. A viewer only moves down after `down_samples` consecutive
+        evaluations call for it, and up one layer at a time after `up_samples`, with the next
+        layer's min_bitrate scaled by `headroom`; this keeps viewers near a threshold from
+        flapping. fraction lost is in RTCP units (n/256).
+
+        Transcoding layers come from `cache` and only exist while a viewer is on them; pass
+        the same cache to every manager of a source so they share filters.
+    '''
+
+    def __init__(self, source, stats, ladder=DEFAULT_LADDER, interval=2, up_samples=3, down_samples=2,
+                 headroom=1.25, max_fraction_lost=26, cache=None):
+        self.source = source
+        self.stats = stats
+        self.cache = cache if cache is not None else LayerCache()
+        self.ladder = ladder
+        self.interval = interval
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.headroom = headroom
+        self.max_fraction_lost = max_fraction_lost
+
+        self.__viewers = {}
+        self.__task = None
+
+    async def __acquire(self, level):
+        layer = self.ladder[level]
+        if layer.width is None:
+            return self.source
+        return await self.cache.acquire(self.source, capsfilter_command(layer))
+
+    async def __release(self, level):
+        layer = self.ladder[level]
+        if layer.width is not None:
+            await self.cache.release(self.source, capsfilter_command(layer))
+
+    def get_layer(self, name):
+        for level, layer in enumerate(self.ladder):
+            if layer.name == name:
+                return level
+        raise ValueError("Unknown layer %s" % name)
+
+    async def add_viewer(self, endpoint, layer=None):
+        level = self.get_layer(layer) if layer is not None else 0
+        element = await self.__acquire(level)
+        try:
+            await element.connect(endpoint)
+        except Exception:
+            await self.__release(level)
+            raise
+        viewer = self.__viewers[endpoint.id] = _Viewer(endpoint, level)
+        self.stats.register(endpoint)
+        return viewer
+
+    async def remove_viewer(self, endpoint):
+        viewer = self.__viewers.pop(endpoint.id, None)
+        self.stats.unregister(endpoint)
+        if viewer is not None:
+            await self.__release(viewer.level)
+
+    async def pin(self, endpoint, layer):
+        '''Keeps a viewer on the given layer, or hands it back to adaptation when layer is None'''
+        viewer = self.__viewers[endpoint.id]
+        viewer.pinned = layer is not None
+        if layer is not None:
+            await self.switch(viewer, self.get_layer(layer))
+
+    async def switch(self, viewer, level):
+        viewer.up_votes = viewer.down_votes = 0
+        if level == viewer.level:
+            return
+
+        logger.info("LAYERS: switching %s from %s to %s" % (viewer.endpoint.id, self.ladder[viewer.level].name,
+                                                            self.ladder[level].name))
+        element = await self.__acquire(level)
+        try:
+            # KMS replaces the sink's current source connection on connect
+            await element.connect(viewer.endpoint)
+        except Exception:
+            # the viewer stays on its current layer
+            await self.__release(level)
+            raise
+        previous, viewer.level = viewer.level, level
+        await self.__release(previous)
+
+    def target_level(self, viewer, sample):
+        if sample.fraction_lost > self.max_fraction_lost:
+            return max(0, viewer.level - 1)
+
+        bandwidth = sample.remb
+        if not bandwidth:
+            if sample.fraction_lost == 0:
+                return min(len(self.ladder) - 1, viewer.level + 1)
+            return viewer.level
+
+        level = 0
+        for candidate, layer in enumerate(self.ladder):
+            required = layer.min_bitrate * (self.headroom if candidate > viewer.level else 1)
+            if bandwidth >= required:
+                level = candidate
+        return level
+
+    async def evaluate(self):
+        for viewer in list(self.__viewers.values()):
+            if viewer.pinned:
+                continue
+            sample = self.stats.latest(viewer.endpoint)
+            # each sample only counts once towards a switch
+            if sample is None or sample is viewer.last_sample:
+                continue
+            viewer.last_sample = sample
+
+            level = self.target_level(viewer, sample)
+            if level < viewer.level:
+                viewer.up_votes = 0
+                viewer.down_votes += 1
+                if viewer.down_votes >= self.down_samples:
+                    await self.switch(viewer, level)
+            elif level > viewer.level:
+                viewer.down_votes = 0
+                viewer.up_votes += 1
+                if viewer.up_votes >= self.up_samples:
+                    await self.switch(viewer, viewer.level + 1)
+            else:
+                viewer.up_votes = viewer.down_votes = 0
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.evaluate()
+            except Exception as ex:
+                logger.error("LAYERS: evaluation failed: %s" % ex)
+
+    async def release(self):
+        await self.stop()
+        for viewer in list(self.__viewers.values()):
+            await self.remove_viewer(viewer.endpoint)
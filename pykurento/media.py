@@ -1,9 +1,12 @@
+import json
 import logging
 
 from functools import wraps
 from inspect import getcallargs
 from asyncinit import asyncinit
 
+from pykurento.events import EventStream, OverflowPolicy
+
 logger = logging.getLogger(__name__)
 
 
@@ -61,16 +64,49 @@ class MediaObject(object):
     async def invoke(self, method, **args):
         return await self.get_transport().invoke(self.id, method, **args)
 
+    async def invoke_shared(self, method, **args):
+        '''Invoke for idempotent getters: concurrent identical calls share one request'''
+        key = (self.id, method, json.dumps(args, sort_keys=True))
+        return await self.get_transport().single_flight.do(key, self.invoke, method, **args)
+
     @grab_session_id
     async def subscribe(self, event, fn, s, n):
-        async def _callback(value, name, session):
-            await fn(value, self, session, name)
+        async def _callback(event, name, session):
+            await fn(event, self, session, name)
 
         return await self.get_transport().subscribe(self.id, event, _callback, n, s)
 
     @grab_session_id
-    def unsubscribe(self, subscription_id):
-        self.get_transport().unsubscribe(self.id, subscription_id)
+    async def unsubscribe(self, subscription_id):
+        return await self.get_transport().unsubscribe(self.id, subscription_id)
+
+    def events(self, *event_types, maxsize=64, overflow=OverflowPolicy.DROP_OLDEST):
+        '''
+            Stream events of the given types, e.g.
+
+                async with endpoint.events("IceCandidateFound", "MediaStateChanged") as stream:
+                    async for event in stream:
+                        ...
+        '''
+        return EventStream(self, event_types, maxsize=maxsize, overflow=overflow)
+
+    def get_children(self):
+        return self.invoke_shared("getChildren")
+
+    def get_creation_time(self):
+        return self.invoke_shared("getCreationTime")
+
+    def add_tag(self, key, value):
+        return self.invoke("addTag", key=key, value=value)
+
+    def remove_tag(self, key):
+        return self.invoke("removeTag", key=key)
+
+    def get_tag(self, key):
+        return self.invoke_shared("getTag", key=key)
+
+    def get_tags(self):
+        return self.invoke_shared("getTags")
 
     @grab_session_id
     async def release(self):
@@ -81,6 +117,43 @@ class MediaPipeline(MediaObject):
     def get_pipeline(self):
         return self
 
+    async def release(self):
+        leases = getattr(self.parent, 'leases', None)
+        if leases is not None:
+            leases.forget(self)
+        return await super(MediaPipeline, self).release()
+
+
+class ServerManager(MediaObject):
+    '''Introspection of the media server; KMS creates it at startup, so it is only looked up by id'''
+
+    ID = "manager_ServerManager"
+
+    def get_pipeline(self):
+        '''The manager belongs to no pipeline'''
+        return None
+
+    def get_pipelines(self):
+        return self.invoke_shared("getPipelines")
+
+    def get_sessions(self):
+        return self.invoke_shared("getSessions")
+
+    def get_info(self):
+        return self.invoke_shared("getInfo")
+
+    def get_used_memory(self):
+        '''Resident memory of the KMS process in KiB'''
+        return self.invoke_shared("getUsedMemory")
+
+    def get_cpu_count(self):
+        return self.invoke_shared("getCpuCount")
+
+    def get_used_cpu(self, interval=1000):
+        '''Average CPU use in percent over the next interval milliseconds, KMS answers once it has passed'''
+        return self.invoke_shared("getUsedCpu", interval=interval)
+
+
 @asyncinit
 class MediaElement(MediaObject):
     async def __init__(self, parent, **args):
@@ -100,17 +173,22 @@ class MediaElement(MediaObject):
         return self.invoke("setVideoFormat", caps=caps)
 
     def get_source_connections(self, media_type):
-        return self.invoke("getSourceConnections", mediaType=media_type)
+        return self.invoke_shared("getSourceConnections", mediaType=media_type)
 
     def get_sink_connections(self, media_type):
-        return self.invoke("getSinkConnections", mediaType=media_type)
+        return self.invoke_shared("getSinkConnections", mediaType=media_type)
+
+    async def get_stats(self, media_type=None):
+        if media_type is None:
+            return await self.invoke_shared("getStats")
+        return await self.invoke_shared("getStats", mediaType=media_type)
 
 
 # ENDPOINTS
 
 class UriEndpoint(MediaElement):
     def get_uri(self):
-        return self.invoke("getUri")
+        return self.invoke_shared("getUri")
 
     def pause(self):
         return self.invoke("pause")
@@ -142,7 +220,7 @@ class SessionEndpoint(MediaElement):
 
 class HttpEndpoint(SessionEndpoint):
     def get_url(self):
-        return self.invoke("getUrl")
+        return self.invoke_shared("getUrl")
 
 
 class HttpGetEndpoint(HttpEndpoint):
@@ -165,10 +243,10 @@ class SdpEndpoint(SessionEndpoint):
         return self.invoke("processAnswer", answer=answer)
 
     def get_local_session_descriptor(self):
-        return self.invoke("getLocalSessionDescriptor")
+        return self.invoke_shared("getLocalSessionDescriptor")
 
     def get_remote_session_descriptor(self):
-        return self.invoke("getRemoteSessionDescriptor")
+        return self.invoke_shared("getRemoteSessionDescriptor")
 
     async def add_ice_candidate(self, ice_candidate_data):
         await self.invoke("addIceCandidate", candidate=ice_candidate_data)
@@ -182,8 +260,8 @@ class SdpEndpoint(SessionEndpoint):
     async def on_ice_candidate_found_event(self, fn, session, name):
         return await self.subscribe("IceCandidateFound", fn, session, name)
 
-    def on_ice_gathering_done_event(self, fn):
-        return self.subscribe("IceGatheringDone", fn)
+    async def on_ice_gathering_done_event(self, fn, session, name):
+        return await self.subscribe("IceGatheringDone", fn, session, name)
 
     def on_new_candidate_pair_selected_event(self, fn):
         return self.subscribe("NewCandidatePairSelected", fn)
@@ -230,13 +308,31 @@ class ZBarFilter(MediaElement):
 
 # HUBS
 
-class Composite(MediaElement):
-    pass
+class Hub(MediaElement):
+    async def create_hub_port(self):
+        return await HubPort(self)
 
 
-class Dispatcher(MediaElement):
-    pass
+class HubPort(MediaElement):
+    async def __init__(self, parent, **args):
+        # hub ports are created on their hub rather than on the pipeline
+        if 'id' not in args:
+            args["hub"] = parent.id
+        await MediaObject.__init__(self, parent, **args)
 
 
-class DispatcherOneToMany(MediaElement):
+class Composite(Hub):
     pass
+
+
+class Dispatcher(Hub):
+    def connect_ports(self, source, sink):
+        return self.invoke("connect", source=source.id, sink=sink.id)
+
+
+class DispatcherOneToMany(Hub):
+    def set_source(self, source):
+        return self.invoke("setSource", source=source.id)
+
+    def remove_source(self):
+        return self.invoke("removeSource")
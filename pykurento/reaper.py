@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+from pykurento.transport import result_value
+
+logger = logging.getLogger(__name__)
+
+
+# tags pykurento puts on the pipelines it creates
+OWNER_TAG = "pykurento.owner"
+LEASE_TAG = "pykurento.lease"
+
+
+def _tags(result):
+    return dict((tag.get("key"), tag.get("value")) for tag in (result_value(result) or []))
+
+
+class PipelineLeases(object):
+    '''
+        Marks the pipelines of one application instance as owned and alive
+
+        Tracked pipelines are tagged with `owner` and a lease expiry (unix time), and the
+        lease is renewed every `renew_interval` seconds while the instance runs. Once the
+        instance dies its leases run out and a PipelineReaper can release the pipelines.
+    '''
+
+    def __init__(self, owner, duration=90, renew_interval=30, max_concurrency=4):
+        self.owner = owner
+        self.duration = duration
+        self.renew_interval = renew_interval
+
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__pipelines = {}
+        self.__task = None
+
+    async def track(self, pipeline):
+        self.__pipelines[pipeline.id] = pipeline
+        # lease first: dying in between leaves an untagged pipeline, not an owned one without a lease
+        await self.__renew(pipeline)
+        await pipeline.add_tag(OWNER_TAG, self.owner)
+
+    def forget(self, pipeline):
+        self.__pipelines.pop(pipeline.id, None)
+
+    def __len__(self):
+        return len(self.__pipelines)
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            await self.renew_once()
+
+    async def renew_once(self):
+        await asyncio.gather(*[self.__renew(pipeline) for pipeline in list(self.__pipelines.values())])
+
+    async def __renew(self, pipeline):
+        async with self.__semaphore:
+            try:
+                await pipeline.add_tag(LEASE_TAG, str(int(time.time() + self.duration)))
+            except Exception as ex:
+                # most likely released behind our back, nothing left to keep alive
+                logger.debug("Could not renew the lease of %s, forgetting it: %s" % (pipeline.id, ex))
+                self.__pipelines.pop(pipeline.id, None)
+
+
+class PipelineReaper(object):
+    '''
+        Releases pipelines whose owner stopped renewing their lease
+
+        Every `interval` seconds the server's pipelines are listed and their tags read, with
+        at most `max_concurrency` requests in flight. Pipelines whose lease expired more than
+        `grace` seconds ago are released `batch_size` at a time, as are owned pipelines that
+        never got a lease once older than `lease_duration` plus `grace`. Untagged pipelines,
+        created by something not using leases, are left alone unless `untagged_age` is set,
+        in which case they are released once older than that many seconds.
+    '''
+
+    def __init__(self, kurento, interval=60, grace=30, batch_size=8, max_concurrency=4, untagged_age=None,
+                 lease_duration=90):
+        self.kurento = kurento
+        self.interval = interval
+        self.grace = grace
+        # PipelineLeases.duration of the owners
+        self.lease_duration = lease_duration
+        self.batch_size = batch_size
+        self.untagged_age = untagged_age
+
+        self.reaped = 0
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            try:
+                await self.reap_once()
+            except Exception as ex:
+                logger.warning("Pipeline reaping failed: %s" % ex)
+            await asyncio.sleep(self.interval)
+
+    async def reap_once(self):
+        '''Releases the stale pipelines found on the server; returns their ids'''
+        manager = await self.kurento.get_server_manager()
+        pipeline_ids = result_value(await manager.get_pipelines()) or []
+
+        pipelines = await asyncio.gather(*[self.__inspect(pipeline_id) for pipeline_id in pipeline_ids])
+        stale = [pipeline for pipeline in pipelines if pipeline is not None]
+
+        reaped = []
+        for start in range(0, len(stale), self.batch_size):
+            batch = stale[start:start + self.batch_size]
+            results = await asyncio.gather(*[pipeline.release() for pipeline in batch], return_exceptions=True)
+            for pipeline, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.debug("Could not release stale pipeline %s: %s" % (pipeline.id, result))
+                else:
+                    reaped.append(pipeline.id)
+
+        if reaped:
+            logger.info("Released %d stale pipelines of %d" % (len(reaped), len(pipeline_ids)))
+        self.reaped += len(reaped)
+        return reaped
+
+    async def __inspect(self, pipeline_id):
+        '''The pipeline if it is stale, None otherwise'''
+        async with self.__semaphore:
+            try:
+                pipeline = await self.kurento.get_pipeline(pipeline_id)
+                tags = _tags(await pipeline.get_tags())
+                now = time.time()
+
+                if OWNER_TAG not in tags:
+                    if self.untagged_age is None:
+                        return None
+                    created = result_value(await pipeline.get_creation_time())
+                    return pipeline if created is not None and now - created > self.untagged_age else None
+
+                lease = tags.get(LEASE_TAG)
+                if lease is None:
+                    # its owner died while tagging it, or predates writing the lease first
+                    created = result_value(await pipeline.get_creation_time())
+                    if created is None or now - created <= self.lease_duration + self.grace:
+                        return None
+                    logger.debug("Pipeline %s of %s never got a lease" % (pipeline_id, tags[OWNER_TAG]))
+                    return pipeline
+                if now <= float(lease) + self.grace:
+                    return None
+                logger.debug("Pipeline %s of %s lease expired %ds ago" % (pipeline_id, tags[OWNER_TAG],
+                                                                          now - float(lease)))
+                return pipeline
+            except Exception as ex:
+                logger.debug("Could not inspect pipeline %s: %s" % (pipeline_id, ex))
+                return None
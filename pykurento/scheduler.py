@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(object):
+    # calls an existing call is waiting on to get media flowing: offers, candidates, connects, subscriptions
+    CRITICAL = 0
+    # new media objects, and tagging them with their owner's lease
+    CREATE = 1
+    # anything that can wait: stats, introspection, releases and unsubscriptions
+    HOUSEKEEPING = 2
+    # introspection KMS takes a while to answer: getUsedCpu measures for its whole interval
+    SLOW = 3
+
+    NAMES = {CRITICAL: "critical", CREATE: "create", HOUSEKEEPING: "housekeeping", SLOW: "slow"}
+
+
+# create_pipeline waits for the lease tags, so they don't queue behind stats polls
+CREATE_OPERATIONS = frozenset(["addTag", "removeTag"])
+
+HOUSEKEEPING_OPERATIONS = frozenset([
+    "getStats", "getChildren", "getCreationTime", "getTag", "getTags",
+    "getPipelines", "getSessions", "getInfo", "getUsedMemory", "getCpuCount",
+])
+
+SLOW_OPERATIONS = frozenset(["getUsedCpu"])
+
+
+def classify(rpc_type, args):
+    if rpc_type == "create":
+        return Priority.CREATE
+    if rpc_type in ("release", "unsubscribe"):
+        return Priority.HOUSEKEEPING
+    if rpc_type == "invoke":
+        operation = args.get("operation")
+        if operation in CREATE_OPERATIONS:
+            return Priority.CREATE
+        if operation in HOUSEKEEPING_OPERATIONS:
+            return Priority.HOUSEKEEPING
+        if operation in SLOW_OPERATIONS:
+            return Priority.SLOW
+    return Priority.CRITICAL
+
+
+class _ClassStats(object):
+    __slots__ = ("queued", "in_flight", "started", "waited", "max_wait", "recent")
+
+    def __init__(self, history):
+        self.queued = 0
+        self.in_flight = 0
+        self.started = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.recent = deque(maxlen=history)
+
+    def record(self, wait):
+        self.started += 1
+        self.waited += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RpcScheduler(object):
+    '''
+        Admits RPCs to one media server by priority class
+
+        At most `max_in_flight` requests are outstanding on the server, and at most
+        `limits[priority]` of a class (None for no class limit). When a slot frees up the
+        oldest waiter of the most urgent class that is under its limit goes next, so a burst
+        of creates or stats polls can't hold back offers and candidates of running calls, and
+        slow introspection such as getUsedCpu only ever holds a slot of its own class.
+        Queue wait per class is kept for the last `history` requests, see stats().
+    '''
+
+    DEFAULT_LIMITS = {Priority.CRITICAL: None, Priority.CREATE: 8, Priority.HOUSEKEEPING: 4, Priority.SLOW: 1}
+
+    def __init__(self, max_in_flight=32, limits=None, history=256):
+        self.max_in_flight = max_in_flight
+        self.limits = dict(self.DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+
+        self.in_flight = 0
+        self.__waiters = dict((priority, deque()) for priority in Priority.NAMES)
+        self.__stats = dict((priority, _ClassStats(history)) for priority in Priority.NAMES)
+
+    def __has_room(self, priority):
+        if self.in_flight >= self.max_in_flight:
+            return False
+        limit = self.limits.get(priority)
+        return limit is None or self.__stats[priority].in_flight < limit
+
+    def __start(self, priority, wait):
+        self.in_flight += 1
+        stats = self.__stats[priority]
+        stats.in_flight += 1
+        stats.record(wait)
+
+    def __dispatch(self):
+        for priority in sorted(self.__waiters):
+            waiters = self.__waiters[priority]
+            while waiters and self.__has_room(priority):
+                future, queued_at = waiters.popleft()
+                self.__stats[priority].queued -= 1
+                self.__start(priority, time.monotonic() - queued_at)
+                future.set_result(None)
+
+    async def acquire(self, priority):
+        more_urgent_waiting = any(self.__waiters[other] for other in self.__waiters if other <= priority)
+        if not more_urgent_waiting and self.__has_room(priority):
+            self.__start(priority, 0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, time.monotonic())
+        self.__waiters[priority].append(waiter)
+        self.__stats[priority].queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # granted just as we were cancelled, hand the slot on
+                self.release(priority)
+            else:
+                self.__waiters[priority].remove(waiter)
+                self.__stats[priority].queued -= 1
+            raise
+
+    def release(self, priority):
+        self.in_flight -= 1
+        self.__stats[priority].in_flight -= 1
+        self.__dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self):
+        '''Per class: queued and in-flight requests, requests started, and queue wait in seconds'''
+        result = {}
+        for priority, stats in self.__stats.items():
+            result[Priority.NAMES[priority]] = dict(
+                queued=stats.queued,
+                in_flight=stats.in_flight,
+                started=stats.started,
+                mean_wait=stats.waited / stats.started if stats.started else 0.0,
+                max_wait=stats.max_wait,
+                p50_wait=_percentile(stats.recent, 0.5),
+                p95_wait=_percentile(stats.recent, 0.95),
+            )
+        return result
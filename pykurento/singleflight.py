@@ -0,0 +1,38 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    '''
+        Coalesces concurrent calls with the same key onto one in-flight call
+
+        Callers arriving while a call for their key is running await that call and get
+        its result or exception; once it completes the next call for the key runs again.
+    '''
+
+    def __init__(self):
+        self.__calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self.__calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            self.__calls[key] = future
+            future.add_done_callback(lambda f: self.__forget(key, f))
+        else:
+            logger.debug("Joining in-flight call for %s" % (key,))
+
+        # shielded, a cancelled caller must not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def __forget(self, key, future):
+        if self.__calls.get(key) is future:
+            del self.__calls[key]
+
+    def in_flight(self, key):
+        return key in self.__calls
+
+    def __len__(self):
+        return len(self.__calls)
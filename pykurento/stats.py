@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+
+from collections import deque, namedtuple
+
+from pykurento.transport import result_value
+
+logger = logging.getLogger(__name__)
+
+
+# one reduced getStats result; bitrates in bits per second, rtt and jitter as reported by KMS
+StatsSample = namedtuple("StatsSample", [
+    "timestamp", "inbound_bitrate", "outbound_bitrate", "packets_lost", "fraction_lost", "jitter", "rtt", "remb",
+])
+
+
+def reduce_stats(stats):
+    '''Reduces the map returned by getStats to totals over its inbound and outbound RTP stats'''
+    bytes_received = bytes_sent = packets_lost = 0
+    fraction_lost = jitter = rtt = 0
+    remb = None
+
+    for stat in stats.values():
+        stat_type = stat.get("type")
+        if stat_type == "inboundrtp":
+            bytes_received += stat.get("bytesReceived", 0)
+            packets_lost += stat.get("packetsLost", 0)
+            fraction_lost = max(fraction_lost, stat.get("fractionLost", 0))
+            jitter = max(jitter, stat.get("jitter", 0))
+        elif stat_type == "outboundrtp":
+            bytes_sent += stat.get("bytesSent", 0)
+            packets_lost += stat.get("packetsLost", 0)
+            fraction_lost = max(fraction_lost, stat.get("fractionLost", 0))
+            rtt = max(rtt, stat.get("roundTripTime", 0))
+            if stat.get("remb"):
+                remb = stat["remb"] if remb is None else min(remb, stat["remb"])
+
+    return bytes_received, bytes_sent, packets_lost, fraction_lost, jitter, rtt, remb
+
+
+class _Entry(object):
+    __slots__ = ("endpoint", "room", "participant", "samples", "bytes_received", "bytes_sent", "last_sampled",
+                 "failures")
+
+    def __init__(self, endpoint, room, participant, history):
+        self.endpoint = endpoint
+        self.room = room
+        self.participant = participant
+        self.samples = deque(maxlen=history)
+        self.bytes_received = None
+        self.bytes_sent = None
+        self.last_sampled = None
+        self.failures = 0
+
+
+class StatsSampler(object):
+    '''
+        Polls getStats on registered endpoints every `interval` seconds
+
+        At most `max_concurrency` getStats requests are in flight at once, so sampling many
+        endpoints never floods the transport. The last `history` samples of each endpoint
+        are kept, and endpoints failing `max_failures` times in a row are dropped.
+    '''
+
+    def __init__(self, interval=5, max_concurrency=4, history=60, max_failures=3, media_type=None):
+        self.interval = interval
+        self.history = history
+        self.max_failures = max_failures
+        self.media_type = media_type
+
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__entries = {}
+        self.__task = None
+
+    def register(self, endpoint, room=None, participant=None):
+        if endpoint.id not in self.__entries:
+            self.__entries[endpoint.id] = _Entry(endpoint, room, participant, self.history)
+
+    def unregister(self, endpoint):
+        self.__entries.pop(endpoint.id, None)
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            started = time.monotonic()
+            await self.sample_once()
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    async def sample_once(self):
+        await asyncio.gather(*[self.__sample(entry) for entry in list(self.__entries.values())])
+
+    async def __sample(self, entry):
+        async with self.__semaphore:
+            try:
+                result = await entry.endpoint.get_stats(self.media_type)
+            except Exception as ex:
+                entry.failures += 1
+                logger.debug("Could not get stats of %s: %s" % (entry.endpoint.id, ex))
+                if entry.failures >= self.max_failures:
+                    logger.info("Dropping %s from stats sampling after %d failures" % (entry.endpoint.id, entry.failures))
+                    self.__entries.pop(entry.endpoint.id, None)
+                return
+
+        entry.failures = 0
+        stats = result_value(result) or {}
+        now = time.monotonic()
+        bytes_received, bytes_sent, packets_lost, fraction_lost, jitter, rtt, remb = reduce_stats(stats)
+
+        inbound_bitrate = outbound_bitrate = 0
+        if entry.last_sampled is not None and now > entry.last_sampled:
+            elapsed = now - entry.last_sampled
+            inbound_bitrate = max(0, bytes_received - entry.bytes_received) * 8 / elapsed
+            outbound_bitrate = max(0, bytes_sent - entry.bytes_sent) * 8 / elapsed
+
+        entry.bytes_received = bytes_received
+        entry.bytes_sent = bytes_sent
+        entry.last_sampled = now
+        entry.samples.append(StatsSample(time.time(), inbound_bitrate, outbound_bitrate, packets_lost,
+                                         fraction_lost, jitter, rtt, remb))
+
+    def __select(self, room, participant):
+        for endpoint_id, entry in self.__entries.items():
+            if room is not None and entry.room != room:
+                continue
+            if participant is not None and entry.participant != participant:
+                continue
+            yield endpoint_id, entry
+
+    def series(self, room=None, participant=None):
+        '''Samples per endpoint id, oldest first'''
+        return dict((endpoint_id, list(entry.samples)) for endpoint_id, entry in self.__select(room, participant))
+
+    def latest(self, endpoint):
+        entry = self.__entries.get(endpoint.id)
+        if entry is None or not entry.samples:
+            return None
+        return entry.samples[-1]
+
+    def room_load(self):
+        '''Latest inbound and outbound bitrate summed per room, heaviest room first'''
+        load = {}
+        for _, entry in self.__select(None, None):
+            if not entry.samples:
+                continue
+            sample = entry.samples[-1]
+            inbound, outbound, endpoints = load.get(entry.room, (0, 0, 0))
+            load[entry.room] = (inbound + sample.inbound_bitrate, outbound + sample.outbound_bitrate, endpoints + 1)
+
+        return sorted(((room, dict(inbound_bitrate=inbound, outbound_bitrate=outbound, endpoints=endpoints))
+                       for room, (inbound, outbound, endpoints) in load.items()),
+                      key=lambda item: item[1]['inbound_bitrate'] + item[1]['outbound_bitrate'], reverse=True)
+
+
+# one ServerManager reading; used_cpu in percent, used_memory in KiB, elements maps pipeline ids to their child count
+ServerLoad = namedtuple("ServerLoad", [
+    "timestamp", "cpu_count", "used_cpu", "used_memory", "pipelines", "elements",
+])
+
+
+class ServerLoadSampler(object):
+    '''
+        Caches the load of a media server, read through its ServerManager every `interval` seconds
+
+        Placement and admission decisions read `load` and `saturated()` instead of asking KMS
+        on every join. getUsedCpu makes KMS measure for `cpu_interval` milliseconds before it
+        answers; with `per_pipeline` the children of every pipeline are counted as well, with
+        at most `max_concurrency` of those requests in flight.
+    '''
+
+    def __init__(self, kurento, interval=10, cpu_interval=1000, per_pipeline=True, max_concurrency=4,
+                 max_cpu=85, max_memory=None, max_elements=None):
+        self.kurento = kurento
+        self.interval = interval
+        self.cpu_interval = cpu_interval
+        self.per_pipeline = per_pipeline
+        self.max_cpu = max_cpu
+        self.max_memory = max_memory
+        self.max_elements = max_elements
+
+        self.load = None
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__server_manager = None
+        self.__cpu_count = None
+        self.__task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.sample_once()
+            except Exception as ex:
+                logger.warning("Could not sample media server load: %s" % ex)
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    async def sample_once(self):
+        if self.__server_manager is None:
+            self.__server_manager = await self.kurento.get_server_manager()
+        manager = self.__server_manager
+        if self.__cpu_count is None:
+            self.__cpu_count = result_value(await manager.get_cpu_count())
+
+        used_cpu, used_memory, pipelines = await asyncio.gather(manager.get_used_cpu(self.cpu_interval),
+                                                                manager.get_used_memory(),
+                                                                manager.get_pipelines())
+        pipelines = result_value(pipelines) or []
+
+        elements = {}
+        if self.per_pipeline:
+            counts = await asyncio.gather(*[self.__count_children(pipeline_id) for pipeline_id in pipelines])
+            elements = dict((pipeline_id, count) for pipeline_id, count in zip(pipelines, counts) if count is not None)
+
+        self.load = ServerLoad(time.time(), self.__cpu_count, result_value(used_cpu), result_value(used_memory),
+                               len(pipelines), elements)
+        return self.load
+
+    async def __count_children(self, pipeline_id):
+        async with self.__semaphore:
+            try:
+                pipeline = await self.kurento.get_pipeline(pipeline_id)
+                return len(result_value(await pipeline.get_children()) or [])
+            except Exception as ex:
+                # pipelines come and go between getPipelines and getChildren
+                logger.debug("Could not count the elements of %s: %s" % (pipeline_id, ex))
+                return None
+
+    def is_fresh(self):
+        return self.load is not None and time.time() - self.load.timestamp <= 3 * self.interval
+
+    def saturated(self):
+        '''True if the last fresh reading exceeds a limit; without one the server is given the benefit of the doubt'''
+        if not self.is_fresh():
+            return False
+        load = self.load
+        if self.max_cpu is not None and load.used_cpu is not None and load.used_cpu >= self.max_cpu:
+            return True
+        if self.max_memory is not None and load.used_memory is not None and load.used_memory >= self.max_memory:
+            return True
+        if self.max_elements is not None and sum(load.elements.values()) >= self.max_elements:
+            return True
+        return False
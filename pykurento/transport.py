@@ -10,6 +10,11 @@ import sys
 
 from queue import Queue
 from collections import defaultdict
+from functools import wraps
+
+from pykurento.events import build_event
+from pykurento.scheduler import RpcScheduler, classify
+from pykurento.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
@@ -47,43 +52,113 @@ class KurentoTransportException(Exception):
         return "%s - %s" % (str(self.message), json.dumps(self.response))
 
 
+def result_value(result):
+    '''The value of an invoke result, None if KMS returned none; 0, "" and [] are values too'''
+    return result[1] if isinstance(result, tuple) else None
+
+
+def on_io_loop(f):
+    '''Runs the coroutine on the transport's I/O loop when it has one, awaiting it from the caller's loop'''
+
+    @wraps(f)
+    async def decorator(self, *args, **kwargs):
+        if self._off_io_loop():
+            return await self._in_io_loop(f(self, *args, **kwargs))
+        return await f(self, *args, **kwargs)
+
+    return decorator
+
+
 class KurentoTransport(object):
     def __init__(self, url, **kwargs):
         logger.debug("Creating new KurentoTransport with url: %s" % url)
         self.url = url
         self.current_id = 0
         self.session_id = None
+        # response futures of outstanding requests, by request id
         self.pending_operations = {}
+        # seconds to wait for a response before failing the request and freeing its scheduler slot
+        self.rpc_timeout = kwargs.get('rpc_timeout', 30)
+        # admits requests to KMS by priority; pass the same scheduler to transports sharing a server
+        self.scheduler = kwargs.get('scheduler') or RpcScheduler(kwargs.get('max_in_flight', 32),
+                                                                 kwargs.get('rpc_limits'))
+        # local listeners, keyed by listener id
         self.subscriptions = {}
-        self.subscriptions_by_event_type = defaultdict(list)
+        # listener ids per (object id, event type)
+        self.subscriptions_by_source = defaultdict(list)
+        # one KMS subscription per (object id, event type), shared by all its local listeners
+        self.kms_subscriptions = {}
+        self.current_listener_id = 0
+        # shares in-flight idempotent invocations, see MediaObject.invoke_shared
+        self.single_flight = SingleFlight()
         self.stopped = False
 
-        # self.event_loop_a = asyncio.new_event_loop()
-
-        # self.thread = threading.Thread(target=self._callback_a)
-        # self.thread.daemon = True
-        # self.thread.start()
-
         # queue for messages received from Kurento; this is to decouple
         # message handing from the pykurento transport message receiving
         # thread (and avoid potential deadlock);
         self.kms_queue = asyncio.Queue(kwargs.get('kms_queue_size', 64))
 
-        # self.event_loop_b = asyncio.new_event_loop()
-        # self.messaging_thread = threading.Thread(target=self._callback_b)
-        # self.messaging_thread.daemon = True
-        # self.messaging_thread.start()
-
-    # def _callback_a(self):
-    #     asyncio.set_event_loop(self.event_loop_a)
-    #     asyncio.get_event_loop().call_soon_threadsafe(lambda: self._run_thread())
-    #     self.event_loop_a.run_forever()
-    #
-    # def _callback_b(self):
-    #     asyncio.set_event_loop(self.event_loop_b)
-    #     asyncio.get_event_loop().call_soon_threadsafe(lambda: self._process_messages())
-    #     self.event_loop_b.run_forever()
+        # with threaded=True the websocket, parsing and event dispatch run on their own loop in
+        # a thread, so a busy application loop doesn't delay KMS responses and events; callers
+        # keep awaiting the transport from their own loop and callbacks run back on that loop
+        self.io_loop = None
+        self.io_thread = None
+        if kwargs.get('threaded'):
+            self.io_loop = asyncio.new_event_loop()
+            self.io_thread = threading.Thread(target=self._run_io_loop, name="kurento-io", daemon=True)
+            self.io_thread.start()
+
+    def _run_io_loop(self):
+        asyncio.set_event_loop(self.io_loop)
+        self.io_loop.run_forever()
+
+    def _off_io_loop(self):
+        if self.io_loop is None:
+            return False
+        try:
+            return asyncio.get_running_loop() is not self.io_loop
+        except RuntimeError:
+            return True
+
+    async def _in_io_loop(self, coro):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.io_loop))
+
+    def _thread_safe_callback(self, fn):
+        '''
+            Runs a listener on the loop that subscribed it; the I/O loop waits for it as it would
+            for a local one, so events stay in order, BLOCK streams hold delivery back, handler
+            timings are real and exceptions reach the dispatch loop's log
+        '''
+        caller_loop = asyncio.get_running_loop()
+
+        async def callback(event, name, session):
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(fn(event, name, session), caller_loop))
+
+        return callback
 
+    def stop(self):
+        self.stopped = True
+        if self.io_loop is not None:
+            asyncio.run_coroutine_threadsafe(self._stop_io_loop(), self.io_loop)
+        else:
+            self._fail_pending("Transport stopped")
+
+    async def _stop_io_loop(self):
+        self._fail_pending("Transport stopped")
+        # a moment for the failed requests to reach their callers on the other loop
+        await asyncio.sleep(0.1)
+        self.io_loop.stop()
+
+    def _fail_pending(self, reason):
+        '''Fails every request still waiting for a response, none will come on this connection'''
+        pending, self.pending_operations = self.pending_operations, {}
+        for response in pending.values():
+            if not response.done():
+                response.set_exception(KurentoTransportException(reason))
+        if pending:
+            logger.warning("%s, failing %d pending requests" % (reason, len(pending)))
+
+    @on_io_loop
     async def connect(self):
         '''
             Connecting to webSocket server
@@ -109,19 +184,17 @@ class KurentoTransport(object):
         # self.connection.close()
 
     async def _check_connection(self):
-        if hasattr(self, 'connection'):
-            if self.connection.open:
-                return
-
-        else:
-            logger.info("Kurento Client websocket is not connected, reconnecting")
-            try:
-                with Timeout(seconds=5):
-                    self.connection = await websockets.client.connect(self.url)
-                    logger.info("Kurento Client websocket connected!")
-            except TimeoutException:
-                # modifying this exception so we can differentiate in the receiver thread
-                raise KurentoTransportException("Timeout: Kurento Client websocket connection timed out")
+        if getattr(self, 'connection', None) is not None and self.connection.open:
+            return
+
+        logger.info("Kurento Client websocket is not connected, reconnecting")
+        try:
+            with Timeout(seconds=5):
+                self.connection = await websockets.client.connect(self.url)
+                logger.info("Kurento Client websocket connected!")
+        except TimeoutException:
+            # modifying this exception so we can differentiate in the receiver thread
+            raise KurentoTransportException("Timeout: Kurento Client websocket connection timed out")
 
     async def heartbeat(self, connection):
         '''
@@ -137,6 +210,7 @@ class KurentoTransport(object):
                 print('Connection with server closed')
                 break
 
+    @on_io_loop
     async def receive_message(self):
         while not self.stopped:
             try:
@@ -144,21 +218,31 @@ class KurentoTransport(object):
                 with Timeout(seconds=1):
                     msg = await self.connection.recv()
                     resp = json.loads(msg)
-                    if 'result' in resp and 'sessionId' in resp['result']:
-                        self.session_id = resp['result']['sessionId']
-                        self.pending_operations["%d_response" % resp["id"]] = resp
+                    pending = self.pending_operations.pop(resp.get('id'), None)
+                    if pending is not None:
+                        if 'result' in resp and 'sessionId' in resp['result']:
+                            self.session_id = resp['result']['sessionId']
+                        if not pending.done():
+                            pending.set_result(resp)
                     else:
-                        self.kms_queue.put_nowait(msg)
+                        self.kms_queue.put_nowait(resp)
 
             except TimeoutException:
                 logger.debug("WS Receiver Timeout")
+            except websockets.exceptions.ConnectionClosed as ex:
+                logger.error("Kurento Client websocket closed: %s" % ex)
+                self._fail_pending("Kurento Client websocket closed")
             except Exception as ex:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
                 fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
 
                 logger.error("WS Receiver Thread %s: %s in file %s:%s" %
                              (exc_type, str(ex), fname, exc_tb.tb_lineno))
+                if getattr(self, 'connection', None) is None or not self.connection.open:
+                    # reconnecting failed, don't retry in a tight loop
+                    await asyncio.sleep(1)
 
+    @on_io_loop
     async def process_messages(self):
         '''Process messages asynchroneously from receiver thread'''
         while not self.stopped:
@@ -177,54 +261,69 @@ class KurentoTransport(object):
         self.current_id += 1
         return self.current_id
 
-    async def _on_message(self, message):
-        resp = json.loads(message)
-        logger.debug("received message: %s" % message)
+    async def _on_message(self, resp):
+        logger.debug("received message: %s", resp)
 
-        if 'method' in resp:
-            if (resp['method'] == 'onEvent'
-                    and 'params' in resp
-                    and 'value' in resp['params']
-                    and 'data' in resp['params']['value']
-                    and 'type' in resp['params']['value']['data']
-                    and resp['params']['value']['data']['type'] in self.subscriptions_by_event_type.keys()):
+        if resp.get('method') != 'onEvent':
+            return
 
-                event_source = resp['params']['value']['data']['source']
-                event_type = resp['params']['value']['data']['type']
-                event_subscriptions = self.subscriptions_by_event_type[event_type]
+        params = resp.get('params')
+        if not params or 'value' not in params:
+            return
 
-                for sub_id in event_subscriptions:
-                    _, fn, name, session = self.subscriptions[sub_id]
-                    self.session_id = resp['params']['sessionId'] if 'sessionId' in resp['params'] else self.session_id
-                    await fn(resp["params"]["value"], name, session)
+        value = params['value']
+        data = value.get('data')
+        if not data or 'type' not in data:
+            return
 
-    async def _rpc(self, rpc_type, **args):
-        if self.session_id:
-            args["sessionId"] = self.session_id
+        event_type = data['type']
+        event_subscriptions = self.subscriptions_by_source.get((value.get('object', data.get('source')), event_type))
+        if not event_subscriptions:
+            return
+
+        if 'sessionId' in params:
+            self.session_id = params['sessionId']
 
-        request = {
-            "jsonrpc": "2.0",
-            "id": self._next_id(),
-            "method": rpc_type,
-            "params": args
-        }
-        req_key = "%d_request" % request["id"]
-        resp_key = "%d_response" % request["id"]
+        event = build_event(event_type, value)
 
-        self.pending_operations[req_key] = request
+        # copied, handlers may unsubscribe while we iterate
+        for sub_id in list(event_subscriptions):
+            subscription = self.subscriptions.get(sub_id)
+            if subscription is None:
+                continue
+            _, fn, name, session = subscription
+            await fn(event, name, session)
 
-        await self._check_connection()
+    @on_io_loop
+    async def _rpc(self, rpc_type, **args):
+        if self.stopped:
+            raise KurentoTransportException("Transport stopped")
+        if self.session_id:
+            args["sessionId"] = self.session_id
 
-        logger.debug("sending message:  %s" % json.dumps(request))
-        await self.a_send_message(json.dumps(request))
+        async with self.scheduler.slot(classify(rpc_type, args)):
+            request = {
+                "jsonrpc": "2.0",
+                "id": self._next_id(),
+                "method": rpc_type,
+                "params": args
+            }
+            response = asyncio.get_running_loop().create_future()
+            self.pending_operations[request["id"]] = response
 
-        while resp_key not in self.pending_operations:
-            await asyncio.sleep(0.005)
+            try:
+                await self._check_connection()
 
-        resp = self.pending_operations[resp_key]
+                logger.debug("sending message:  %s" % json.dumps(request))
+                await self.a_send_message(json.dumps(request))
 
-        del self.pending_operations[req_key]
-        del self.pending_operations[resp_key]
+                try:
+                    resp = await asyncio.wait_for(response, self.rpc_timeout)
+                except asyncio.TimeoutError:
+                    raise KurentoTransportException("Timeout: no response to %s within %ss" % (
+                        args.get('operation', rpc_type), self.rpc_timeout), request)
+            finally:
+                self.pending_operations.pop(request["id"], None)
 
         if 'error' in resp:
             raise KurentoTransportException(resp['error']['message'] if 'message' in resp['error'] else 'Unknown Error',
@@ -234,7 +333,8 @@ class KurentoTransport(object):
 
             session_id = resp['result']['sessionId']
             value = resp['result'].get('value')
-            result = (session_id, value,) if value else session_id
+            # falsy values such as a used CPU of 0.0 or an empty list are returned all the same
+            result = (session_id, value,) if value is not None else session_id
 
             return result
         else:
@@ -246,19 +346,66 @@ class KurentoTransport(object):
     async def invoke(self, object_id, operation, **args):
         return await self._rpc("invoke", object=object_id, operation=operation, operationParams=args)
 
+    def _next_listener_id(self):
+        self.current_listener_id += 1
+        return "listener_%d" % self.current_listener_id
+
     async def subscribe(self, object_id, event_type, fn, name, session):
-        session_id, subscription_id =  await self._rpc("subscribe", object=object_id, type=event_type)
-        self.subscriptions[subscription_id] = (event_type, fn, name, session)
-        self.subscriptions_by_event_type[event_type].append(subscription_id)
-        return session_id, subscription_id
+        '''
+            Adds a local listener for event_type on object_id
 
+            Only the first listener of an (object, event type) pair subscribes on KMS, later ones
+            share that subscription. Returns (session_id, listener_id); the listener id is what
+            unsubscribe expects.
+        '''
+        if self._off_io_loop():
+            fn = self._thread_safe_callback(fn)
+            return await self._in_io_loop(self.subscribe(object_id, event_type, fn, name, session))
+
+        key = (object_id, event_type)
+        listener_id = self._next_listener_id()
+        self.subscriptions[listener_id] = (event_type, fn, name, session)
+        self.subscriptions_by_source[key].append(listener_id)
+
+        kms_subscription = self.kms_subscriptions.get(key)
+        if kms_subscription is None:
+            kms_subscription = asyncio.ensure_future(self._rpc("subscribe", object=object_id, type=event_type))
+            self.kms_subscriptions[key] = kms_subscription
+
+        try:
+            session_id, _ = await asyncio.shield(kms_subscription)
+        except Exception:
+            if self.kms_subscriptions.get(key) is kms_subscription:
+                del self.kms_subscriptions[key]
+            self._remove_listener(key, listener_id)
+            raise
+
+        return session_id, listener_id
+
+    def _remove_listener(self, key, listener_id):
+        self.subscriptions.pop(listener_id, None)
+        listeners = self.subscriptions_by_source.get(key)
+        if listeners is not None and listener_id in listeners:
+            listeners.remove(listener_id)
+        if not listeners:
+            self.subscriptions_by_source.pop(key, None)
+            return True
+        return False
+
+    @on_io_loop
     async def unsubscribe(self, object_id, subscription_id):
-        event_type, _ = self.subscriptions[subscription_id]
-        event_subscriptions = self.subscriptions_by_event_type[event_type]
-        event_subscriptions.remove(subscription_id)
+        event_type, _, _, _ = self.subscriptions[subscription_id]
+        key = (object_id, event_type)
+
+        if not self._remove_listener(key, subscription_id):
+            return None
+
+        kms_subscription = self.kms_subscriptions.pop(key, None)
+        if kms_subscription is None:
+            return None
 
-        del self.subscriptions[subscription_id]
-        return await self._rpc("unsubscribe", object=object_id, subscription=subscription_id)
+        _, kms_subscription_id = await kms_subscription
+        return await self._rpc("unsubscribe", object=object_id, subscription=kms_subscription_id)
 
     async def release(self, object_id):
         return await self._rpc("release", object=object_id)
@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import json
+import time
+
+from pykurento.transport import KurentoTransportException
+
+
+class FakeKms(object):
+    '''
+        Answers the requests of a KurentoTransport in place of its _rpc, keeping the objects
+        it was asked to create
+
+        Releasing an object releases the objects created on it, as KMS does for pipelines and
+        hubs. Operations listed in `fail` raise instead of being answered. Objects keep their
+        tags and creation time, and the server manager lists the pipelines.
+    '''
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.objects = {}
+        self.children = {}
+        self.tags = {}
+        self.creation_times = {}
+        self.calls = []
+        self.fail = set()
+        self.__ids = itertools.count(1)
+
+    def install(self, transport):
+        transport._rpc = self.rpc
+        return transport
+
+    async def rpc(self, rpc_type, **args):
+        self.calls.append((rpc_type, args))
+        # a moment on the wire, so concurrent requests overlap
+        await asyncio.sleep(self.delay)
+        value = self.handle(rpc_type, args)
+        return ("session", value) if value is not None else "session"
+
+    def handle(self, rpc_type, args):
+        operation = args.get("operation", rpc_type)
+        if operation in self.fail:
+            raise KurentoTransportException("%s failed" % operation, {})
+
+        if rpc_type == "create":
+            params = args["constructorParams"]
+            object_id = "%s-%d" % (args["type"], next(self.__ids))
+            self.objects[object_id] = args["type"]
+            self.children[object_id] = set()
+            self.tags[object_id] = {}
+            self.creation_times[object_id] = int(time.time())
+            parent = params.get("hub") or params.get("mediaPipeline")
+            if parent is not None:
+                self.__check(parent)
+                self.children[parent].add(object_id)
+            return object_id
+
+        if rpc_type == "subscribe":
+            self.__check(args["object"])
+            return "subscription-%d" % next(self.__ids)
+
+        if rpc_type == "release":
+            self.__check(args["object"])
+            self.release(args["object"])
+            return None
+
+        if rpc_type == "invoke":
+            object_id = args["object"]
+            params = args["operationParams"]
+            if operation == "getPipelines":
+                return [object_id for object_id, object_type in self.objects.items() if object_type == "MediaPipeline"]
+            self.__check(object_id)
+            if operation == "processOffer":
+                return "answer to %s" % params["offer"]
+            if operation == "addTag":
+                self.tags[object_id][params["key"]] = params["value"]
+            elif operation == "removeTag":
+                self.tags[object_id].pop(params["key"], None)
+            elif operation == "getTags":
+                return [dict(key=key, value=value) for key, value in self.tags[object_id].items()]
+            elif operation == "getCreationTime":
+                return self.creation_times[object_id]
+            return None
+
+        return None
+
+    def __check(self, object_id):
+        if object_id not in self.objects:
+            raise KurentoTransportException("Object %s not found" % object_id, {})
+
+    def release(self, object_id):
+        for child in list(self.children.get(object_id, ())):
+            if child in self.objects:
+                self.release(child)
+        del self.objects[object_id]
+        del self.children[object_id]
+        del self.tags[object_id]
+        del self.creation_times[object_id]
+        for siblings in self.children.values():
+            siblings.discard(object_id)
+
+    def created(self, object_type):
+        return [args for rpc_type, args in self.calls if rpc_type == "create" and args["type"] == object_type]
+
+    def released(self):
+        return [args["object"] for rpc_type, args in self.calls if rpc_type == "release"]
+
+    def invoked(self, operation):
+        return [args for rpc_type, args in self.calls if args.get("operation") == operation]
+
+
+class FakeSession(object):
+    '''A browser websocket, keeping what was written to it'''
+
+    def __init__(self):
+        self.messages = []
+        self.closed = None
+
+    async def write_message(self, text):
+        self.messages.append(json.loads(text))
+
+    def close(self, code=None, reason=None):
+        self.closed = (code, reason)
+
+    def received(self, message_id):
+        return [message for message in self.messages if message["id"] == message_id]
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+import unittest
+
+# the examples import each other as top-level modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'examples')))
+
+from broadcast.broadcast import Broadcast  # noqa: E402
+from fake_kms import FakeKms, FakeSession  # noqa: E402
+from pykurento import KurentoClient  # noqa: E402
+
+
+class BroadcastTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.kms = FakeKms(delay=0.01)
+        self.kurento = KurentoClient("ws://127.0.0.1:1")
+        self.kms.install(self.kurento.get_transport())
+        self.pipeline = await self.kurento.create_pipeline()
+
+    async def broadcast(self, **kwargs):
+        broadcast = Broadcast("webinar", self.pipeline, batch_window=0.01, **kwargs)
+        await broadcast.create()
+        self.addAsyncCleanup(broadcast.close)
+        return broadcast
+
+    def viewer_peers(self):
+        # every viewer peer plugs its hub port into its endpoint once
+        return len(self.kms.invoked("connect"))
+
+    async def admit(self, broadcast, session, offer="offer"):
+        return await broadcast.admit(session, session.write_message, offer)
+
+    async def test_admitted_in_batches(self):
+        broadcast = await self.broadcast(max_concurrency=2)
+        sessions = [FakeSession() for _ in range(5)]
+        answers = await asyncio.gather(*[self.admit(broadcast, session, "offer %d" % index)
+                                         for index, session in enumerate(sessions)])
+        self.assertEqual(answers, ["answer to offer %d" % index for index in range(5)])
+        self.assertEqual(len({broadcast.get_peer(session).endpoint.id for session in sessions}), 5)
+
+    async def test_failed_offer(self):
+        broadcast = await self.broadcast()
+        self.kms.fail.add("processOffer")
+        session = FakeSession()
+        with self.assertRaises(Exception):
+            await self.admit(broadcast, session)
+        self.assertIsNone(broadcast.get_peer(session))
+
+    async def test_new_offer_releases_previous_peer(self):
+        broadcast = await self.broadcast()
+        session = FakeSession()
+        await self.admit(broadcast, session)
+        first = broadcast.get_peer(session)
+
+        await self.admit(broadcast, session)
+        self.assertIsNot(broadcast.get_peer(session), first)
+        self.assertIn(first.endpoint.id, self.kms.released())
+        self.assertIn(first.hub_port.id, self.kms.released())
+
+    async def test_prewarm_does_not_overshoot(self):
+        broadcast = await self.broadcast()
+        await asyncio.gather(broadcast.prewarm(3), broadcast.prewarm(3), broadcast.prewarm(2))
+        self.assertEqual(self.viewer_peers(), 3)
+        await broadcast.prewarm(3)
+        self.assertEqual(self.viewer_peers(), 3)
+
+    async def test_pool_refilled_after_batch(self):
+        broadcast = await self.broadcast(pool_size=3)
+        self.assertEqual(self.viewer_peers(), 3)
+
+        await asyncio.gather(*[self.admit(broadcast, FakeSession()) for _ in range(2)])
+        await self.admit(broadcast, FakeSession())
+        await asyncio.sleep(0.1)
+        # the three admitted took pooled endpoints, the pool was topped back up to three
+        self.assertEqual(self.viewer_peers(), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import asyncio
+import unittest
+
+from pykurento.events import EventStream, IceCandidateFound, MediaEvent, OverflowPolicy, build_event
+
+
+class FakeObject(object):
+
+    def __init__(self, object_id="endpoint-1"):
+        self.id = object_id
+        self.listeners = {}
+        self.next_id = 0
+
+    async def subscribe(self, event, fn, s=None, n=None, **kwargs):
+        self.next_id += 1
+        self.listeners[self.next_id] = (event, fn, n)
+        return "session", self.next_id
+
+    async def unsubscribe(self, subscription_id):
+        del self.listeners[subscription_id]
+
+    async def emit(self, value):
+        for _, fn, name in list(self.listeners.values()):
+            await fn(value, self, None, name)
+
+
+class MediaEventTest(unittest.TestCase):
+
+    def test_typed(self):
+        candidate = dict(candidate="candidate:1 1 UDP 2013266431 10.0.0.1 40000 typ host", sdpMid="0")
+        value = dict(object="endpoint-1", data=dict(type="IceCandidateFound", source="endpoint-1",
+                                                    candidate=candidate, timestampMillis="1700000000000"))
+        event = build_event("IceCandidateFound", value)
+        self.assertIsInstance(event, IceCandidateFound)
+        self.assertEqual(event.candidate, candidate)
+        self.assertEqual(event.source, "endpoint-1")
+        self.assertEqual(event.object_id, "endpoint-1")
+        self.assertEqual(event.timestamp_millis, "1700000000000")
+        # handlers written against plain dicts keep working
+        self.assertEqual(event['data']['candidate'], candidate)
+        # wrapped, not copied
+        self.assertIs(event.value, value)
+
+    def test_unknown_type(self):
+        event = build_event("SomethingNew", dict(object="endpoint-1", data=dict(type="SomethingNew", answer=42)))
+        self.assertIs(type(event), MediaEvent)
+        self.assertEqual(event.type, "SomethingNew")
+        self.assertEqual(event.data["answer"], 42)
+
+    def test_slotted(self):
+        event = build_event("IceCandidateFound", dict(data=dict(type="IceCandidateFound")))
+        with self.assertRaises(AttributeError):
+            event.extra = 1
+
+
+class EventStreamTest(unittest.IsolatedAsyncioTestCase):
+
+    async def read(self, stream, count):
+        events = []
+        async for event in stream:
+            events.append(event)
+            if len(events) == count:
+                break
+        return events
+
+    async def test_drop_oldest(self):
+        media_object = FakeObject()
+        async with EventStream(media_object, ("MediaStateChanged",), maxsize=2) as stream:
+            for value in range(5):
+                await media_object.emit(value)
+            self.assertEqual(stream.dropped, 3)
+            self.assertEqual(await self.read(stream, 2), [3, 4])
+
+    async def test_drop_newest(self):
+        media_object = FakeObject()
+        async with EventStream(media_object, ("MediaStateChanged",), maxsize=2,
+                               overflow=OverflowPolicy.DROP_NEWEST) as stream:
+            for value in range(5):
+                await media_object.emit(value)
+            self.assertEqual(stream.dropped, 3)
+            self.assertEqual(await self.read(stream, 2), [0, 1])
+
+    async def test_block(self):
+        media_object = FakeObject()
+        async with EventStream(media_object, ("MediaStateChanged",), maxsize=1,
+                               overflow=OverflowPolicy.BLOCK) as stream:
+            events = stream.__aiter__()
+            await media_object.emit(0)
+            # the transport waits until the consumer made room
+            delivering = asyncio.ensure_future(media_object.emit(1))
+            await asyncio.sleep(0.01)
+            self.assertFalse(delivering.done())
+
+            self.assertEqual(await events.__anext__(), 0)
+            await asyncio.wait_for(delivering, 1)
+            self.assertEqual(await events.__anext__(), 1)
+            self.assertEqual(stream.dropped, 0)
+
+    async def test_close_releases_blocked_delivery(self):
+        media_object = FakeObject()
+        stream = EventStream(media_object, ("MediaStateChanged",), maxsize=1, overflow=OverflowPolicy.BLOCK)
+        await stream.subscribe()
+        await media_object.emit(0)
+        delivering = asyncio.ensure_future(media_object.emit(1))
+        await asyncio.sleep(0.01)
+        await stream.aclose()
+        await asyncio.wait_for(delivering, 1)
+
+    async def test_unsubscribes(self):
+        media_object = FakeObject()
+        async with EventStream(media_object, ("MediaStateChanged", "IceCandidateFound")):
+            self.assertEqual(sorted(event for event, _, _ in media_object.listeners.values()),
+                             ["IceCandidateFound", "MediaStateChanged"])
+        self.assertEqual(media_object.listeners, {})
+
+    async def test_break_closes(self):
+        media_object = FakeObject()
+        stream = EventStream(media_object, ("MediaStateChanged",))
+        await stream.subscribe()
+        await media_object.emit(0)
+        self.assertEqual(await self.read(stream, 1), [0])
+        # the abandoned loop's iterator is finalized on the next turns of the loop
+        await asyncio.sleep(0.01)
+        self.assertEqual(media_object.listeners, {})
+
+    async def test_iteration_ends_when_closed(self):
+        media_object = FakeObject()
+        stream = EventStream(media_object, ("MediaStateChanged",))
+        await stream.subscribe()
+        await media_object.emit(0)
+        reading = asyncio.ensure_future(self.read(stream, 2))
+        await asyncio.sleep(0.01)
+        await stream.aclose()
+        self.assertEqual(await asyncio.wait_for(reading, 1), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import asyncio
+import unittest
+
+from unittest import mock
+
+from pykurento import layers
+from pykurento.layers import LayerCache, LayerManager, capsfilter_command
+from pykurento.stats import StatsSample
+
+
+class FakeElement(object):
+    count = 0
+
+    def __init__(self, command=None):
+        FakeElement.count += 1
+        self.id = "element-%d" % FakeElement.count
+        self.command = command
+        self.sinks = []
+        self.released = False
+
+    def get_pipeline(self):
+        return None
+
+    async def connect(self, sink):
+        self.sinks.append(sink)
+
+    async def release(self):
+        self.released = True
+
+
+async def fake_filter(pipeline, command=None, filterType=None):
+    # a moment on the wire, so concurrent acquires overlap
+    await asyncio.sleep(0.01)
+    return FakeElement(command)
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.samples = {}
+
+    def register(self, endpoint, room=None, participant=None):
+        pass
+
+    def unregister(self, endpoint):
+        self.samples.pop(endpoint.id, None)
+
+    def latest(self, endpoint):
+        return self.samples.get(endpoint.id)
+
+    def report(self, endpoint, remb=None, fraction_lost=0):
+        self.samples[endpoint.id] = StatsSample(0, 0, 0, 0, fraction_lost, 0, 0, remb)
+
+
+class LayerCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(layers.media, "GStreamerFilter", fake_filter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = LayerCache()
+        self.source = FakeElement()
+
+    async def test_shared(self):
+        first, second = await asyncio.gather(self.cache.acquire(self.source, "capsfilter a"),
+                                             self.cache.acquire(self.source, "capsfilter a"))
+        self.assertIs(first, second)
+        self.assertEqual(self.source.sinks, [first])
+        self.assertEqual(self.cache.holders(self.source, "capsfilter a"), 2)
+
+        # other commands and other sources get their own
+        other = await self.cache.acquire(self.source, "capsfilter b")
+        elsewhere = await self.cache.acquire(FakeElement(), "capsfilter a")
+        self.assertEqual(len({first.id, other.id, elsewhere.id}), 3)
+        self.assertEqual(len(self.cache), 3)
+
+    async def test_released_with_last_holder(self):
+        element = await self.cache.acquire(self.source, "capsfilter a")
+        await self.cache.acquire(self.source, "capsfilter a")
+
+        await self.cache.release(self.source, "capsfilter a")
+        self.assertFalse(element.released)
+        await self.cache.release(self.source, "capsfilter a")
+        self.assertTrue(element.released)
+        self.assertEqual(len(self.cache), 0)
+
+        # the next acquire creates a new one
+        self.assertIsNot(await self.cache.acquire(self.source, "capsfilter a"), element)
+
+    async def test_failed_creation(self):
+        async def failing(pipeline, command=None, filterType=None):
+            raise RuntimeError("no such plugin")
+
+        with mock.patch.object(layers.media, "GStreamerFilter", failing):
+            with self.assertRaises(RuntimeError):
+                await self.cache.acquire(self.source, "capsfilter a")
+        self.assertEqual(len(self.cache), 0)
+        await self.cache.acquire(self.source, "capsfilter a")
+        self.assertEqual(self.cache.holders(self.source, "capsfilter a"), 1)
+
+    async def test_managers_share_layers(self):
+        managers = [LayerManager(self.source, FakeStats(), cache=self.cache) for _ in range(2)]
+        viewers = [FakeElement(), FakeElement()]
+        for manager, viewer in zip(managers, viewers):
+            await manager.add_viewer(viewer, "med")
+
+        med = capsfilter_command(layers.DEFAULT_LADDER[1])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.holders(self.source, med), 2)
+
+        # the source itself is served without a filter, and an unused layer is released
+        await managers[0].pin(viewers[0], "high")
+        self.assertEqual(self.cache.holders(self.source, med), 1)
+        await managers[1].remove_viewer(viewers[1])
+        self.assertEqual(len(self.cache), 0)
+
+
+class LayerManagerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(layers.media, "GStreamerFilter", fake_filter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.stats = FakeStats()
+        self.manager = LayerManager(FakeElement(), self.stats, up_samples=2, down_samples=2)
+        self.viewer_endpoint = FakeElement()
+
+    async def evaluate(self, times=1, **sample):
+        for _ in range(times):
+            self.stats.report(self.viewer_endpoint, **sample)
+            await self.manager.evaluate()
+
+    async def test_down_needs_consecutive_samples(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint, "high")
+
+        await self.evaluate(remb=100000)
+        self.assertEqual(viewer.level, 2)
+        # a sample only counts once
+        await self.manager.evaluate()
+        self.assertEqual(viewer.level, 2)
+
+        await self.evaluate(remb=100000)
+        self.assertEqual(viewer.level, 0)
+
+    async def test_down_reset_by_good_sample(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint, "high")
+        await self.evaluate(remb=100000)
+        await self.evaluate(remb=2000000)
+        await self.evaluate(remb=100000)
+        self.assertEqual(viewer.level, 2)
+
+    async def test_up_one_layer_at_a_time(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint)
+        await self.evaluate(2, remb=2000000)
+        self.assertEqual(viewer.level, 1)
+        await self.evaluate(2, remb=2000000)
+        self.assertEqual(viewer.level, 2)
+
+    async def test_up_needs_headroom(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint)
+        # enough for med, but not with 25% headroom
+        await self.evaluate(4, remb=330000)
+        self.assertEqual(viewer.level, 0)
+        await self.evaluate(2, remb=380000)
+        self.assertEqual(viewer.level, 1)
+        # once on med, its own min_bitrate is enough to stay
+        await self.evaluate(4, remb=310000)
+        self.assertEqual(viewer.level, 1)
+
+    async def test_loss_without_remb(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint, "med")
+        # probes up while nothing is lost
+        await self.evaluate(2)
+        self.assertEqual(viewer.level, 2)
+        await self.evaluate(2, fraction_lost=60)
+        self.assertEqual(viewer.level, 1)
+
+    async def test_pinned(self):
+        viewer = await self.manager.add_viewer(self.viewer_endpoint)
+        await self.manager.pin(self.viewer_endpoint, "high")
+        self.assertEqual(viewer.level, 2)
+        await self.evaluate(3, remb=100000)
+        self.assertEqual(viewer.level, 2)
+
+        await self.manager.pin(self.viewer_endpoint, None)
+        await self.evaluate(2, remb=100000)
+        self.assertEqual(viewer.level, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
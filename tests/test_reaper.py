@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from fake_kms import FakeKms
+from pykurento import KurentoClient
+from pykurento.reaper import LEASE_TAG, OWNER_TAG, PipelineLeases, PipelineReaper
+
+
+class ReaperTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.kms = FakeKms()
+        self.leases = PipelineLeases("node-a", duration=90)
+        self.kurento = KurentoClient("ws://127.0.0.1:1", leases=self.leases)
+        self.kms.install(self.kurento.get_transport())
+        self.reaper = PipelineReaper(self.kurento, grace=30, batch_size=2, lease_duration=90)
+
+    async def pipeline(self, lease=None, owner="node-b", age=0):
+        '''A pipeline on the server as another node left it, its lease `lease` seconds from now'''
+        pipeline = await KurentoClient("ws://127.0.0.1:1", transport=self.kurento.get_transport()).create_pipeline()
+        if owner is not None:
+            self.kms.tags[pipeline.id][OWNER_TAG] = owner
+        if lease is not None:
+            self.kms.tags[pipeline.id][LEASE_TAG] = str(int(time.time() + lease))
+        self.kms.creation_times[pipeline.id] -= age
+        return pipeline.id
+
+    async def test_leased(self):
+        pipeline = await self.kurento.create_pipeline()
+        tags = self.kms.tags[pipeline.id]
+        self.assertEqual(tags[OWNER_TAG], "node-a")
+        self.assertGreater(int(tags[LEASE_TAG]), time.time() + 80)
+        # the lease goes on before the owner
+        add_tags = [args["operationParams"]["key"] for args in self.kms.invoked("addTag")]
+        self.assertEqual(add_tags, [LEASE_TAG, OWNER_TAG])
+
+        tags[LEASE_TAG] = "0"
+        await self.leases.renew_once()
+        self.assertGreater(int(tags[LEASE_TAG]), time.time() + 80)
+
+        await pipeline.release()
+        self.assertEqual(len(self.leases), 0)
+
+    async def test_expired_lease_reaped(self):
+        expired = await self.pipeline(lease=-60)
+        # within the grace period
+        recent = await self.pipeline(lease=-10)
+        alive = await self.pipeline(lease=60)
+        ours = (await self.kurento.create_pipeline()).id
+
+        self.assertEqual(await self.reaper.reap_once(), [expired])
+        self.assertEqual(sorted(self.kms.objects), sorted([recent, alive, ours]))
+
+    async def test_never_leased(self):
+        young = await self.pipeline(age=60)
+        old = await self.pipeline(age=300)
+        self.assertEqual(await self.reaper.reap_once(), [old])
+        self.assertIn(young, self.kms.objects)
+
+    async def test_untagged(self):
+        untagged = await self.pipeline(owner=None, age=300)
+        self.assertEqual(await self.reaper.reap_once(), [])
+
+        self.reaper.untagged_age = 120
+        self.assertEqual(await self.reaper.reap_once(), [untagged])
+
+    async def test_batches(self):
+        expired = [await self.pipeline(lease=-60) for _ in range(5)]
+        self.assertEqual(sorted(await self.reaper.reap_once()), sorted(expired))
+        self.assertEqual(self.reaper.reaped, 5)
+        self.assertEqual(self.kms.objects, {})
+
+    async def test_failed_release(self):
+        await self.pipeline(lease=-60)
+        self.kms.fail.add("release")
+        self.assertEqual(await self.reaper.reap_once(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import os
+import sys
+import unittest
+
+# the examples import each other as top-level modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'examples')))
+
+from fake_kms import FakeKms, FakeSession  # noqa: E402
+from pykurento import KurentoClient  # noqa: E402
+from rooms.room import ParticipantExists, Room, RoomMode  # noqa: E402
+from rooms.room_manager import RoomManager  # noqa: E402
+
+
+class RoomTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.kms = FakeKms()
+        self.kurento = KurentoClient("ws://127.0.0.1:1")
+        self.kms.install(self.kurento.get_transport())
+        self.pipeline = await self.kurento.create_pipeline()
+
+    async def join(self, room, *names):
+        users = []
+        for name in names:
+            user = await room.join(name, FakeSession())
+            users.append(user)
+        return users
+
+    async def delivered(self):
+        # messages reach the browsers through their outbound queues
+        await asyncio.sleep(0.01)
+
+    def mixers(self):
+        return set(args["constructorParams"]["hub"] for args in self.kms.created("HubPort"))
+
+    async def test_switches_to_mcu(self):
+        room = Room("room", self.pipeline, mcu_threshold=3)
+        alice, bob = await self.join(room, "alice", "bob")
+        self.assertEqual(room.get_mode(), RoomMode.SFU)
+        await alice.receive_video_from(alice, "offer")
+        await alice.receive_video_from(bob, "offer")
+        negotiated = alice.get_outgoing_web_rtc_peer().id
+        self.assertEqual(len(self.kms.invoked("processOffer")), 2)
+
+        carol, = await self.join(room, "carol")
+        self.assertEqual(room.get_mode(), RoomMode.MCU)
+        self.assertEqual(len(self.mixers()), 1)
+        self.assertTrue(all(user.is_mixed() for user in (alice, bob, carol)))
+        # KMS can't take a second offer on alice's negotiated endpoint, so it was replaced, and her
+        # endpoint for bob went with the mesh
+        self.assertIn(negotiated, self.kms.released())
+        self.assertNotEqual(alice.get_outgoing_web_rtc_peer().id, negotiated)
+        self.assertEqual(len(self.kms.released()), 2)
+
+        await self.delivered()
+        mode_message, = alice.get_session().received("roomMode")
+        self.assertEqual(mode_message["mode"], RoomMode.MCU)
+        self.assertEqual(sorted(mode_message["data"]), ["bob", "carol"])
+        # carol learns about the others from roomMode rather than existingParticipants
+        self.assertEqual(carol.get_session().received("existingParticipants"), [])
+
+    async def test_joins_mixed_room(self):
+        room = Room("room", self.pipeline, mcu_threshold=2)
+        await self.join(room, "alice", "bob")
+        carol, = await self.join(room, "carol")
+        self.assertTrue(carol.is_mixed())
+        await self.delivered()
+        existing, = carol.get_session().received("existingParticipants")
+        self.assertEqual(existing["mode"], RoomMode.MCU)
+
+        # a mixed participant only ever negotiates its own endpoint
+        await carol.receive_video_from(room.get_participant("alice"), "offer")
+        self.assertEqual(self.kms.invoked("processOffer"), [])
+
+    async def test_back_to_sfu(self):
+        room = Room("room", self.pipeline, mcu_threshold=2)
+        alice, bob = await self.join(room, "alice", "bob")
+        mixer, = self.mixers()
+        await room.switch_mode(RoomMode.SFU)
+        self.assertEqual(room.get_mode(), RoomMode.SFU)
+        self.assertIn(mixer, self.kms.released())
+        self.assertNotIn(mixer, self.kms.objects)
+        self.assertFalse(alice.is_mixed() or bob.is_mixed())
+        await self.delivered()
+        self.assertEqual([message["mode"] for message in bob.get_session().received("roomMode")],
+                         [RoomMode.MCU, RoomMode.SFU])
+
+    async def test_close(self):
+        room = Room("room", self.pipeline, mcu_threshold=2)
+        await self.join(room, "alice", "bob")
+        await room.close()
+        self.assertIn(self.pipeline.id, self.kms.released())
+        self.assertEqual(len(self.kms.released()), len(set(self.kms.released())))
+
+    async def test_name_taken(self):
+        room = Room("room", self.pipeline)
+        alice, = await self.join(room, "alice")
+        with self.assertRaises(ParticipantExists):
+            await room.join("alice", FakeSession())
+        self.assertIs(room.get_participant("alice"), alice)
+
+        # nor can two joins under one name race each other in
+        results = await asyncio.gather(room.join("bob", FakeSession()), room.join("bob", FakeSession()),
+                                       return_exceptions=True)
+        self.assertEqual(sum(isinstance(result, ParticipantExists) for result in results), 1)
+        self.assertEqual(len(room.get_participants()), 2)
+
+    async def restored(self):
+        room = Room("room", self.pipeline)
+        alice, = await self.join(room, "alice")
+        # another node takes over the room, alice's browser has yet to reconnect
+        restored = Room("room", self.pipeline)
+        await restored.restore(room.describe(), dict(alice=alice.describe()))
+        return restored, alice.get_outgoing_web_rtc_peer().id
+
+    async def test_resumed(self):
+        room, endpoint = await self.restored()
+        session = FakeSession()
+        alice = await room.join("alice", session, resume=True)
+        self.assertEqual(alice.get_outgoing_web_rtc_peer().id, endpoint)
+        await self.delivered()
+        self.assertEqual(len(session.received("sessionResumed")), 1)
+
+        # once back, the name is taken again
+        with self.assertRaises(ParticipantExists):
+            await room.join("alice", FakeSession(), resume=True)
+
+    async def test_restored_started_over(self):
+        room, endpoint = await self.restored()
+        alice = await room.join("alice", FakeSession())
+        self.assertNotEqual(alice.get_outgoing_web_rtc_peer().id, endpoint)
+        self.assertIn(endpoint, self.kms.released())
+
+    async def test_leave(self):
+        room = Room("room", self.pipeline)
+        alice, bob = await self.join(room, "alice", "bob")
+        await alice.receive_video_from(bob, "offer")
+        incoming = (await alice.get_endpoint_for_user(bob)).id
+
+        await room.leave(bob)
+        self.assertIsNone(room.get_participant("bob"))
+        self.assertIn(bob.get_outgoing_web_rtc_peer().id, self.kms.released())
+        # alice's endpoint receiving bob went with him
+        self.assertIn(incoming, self.kms.released())
+        await self.delivered()
+        left, = alice.get_session().received("participantLeft")
+        self.assertEqual(left["name"], "bob")
+
+        # the name can be taken again
+        await self.join(room, "bob")
+
+
+class RoomManagerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.kms = FakeKms()
+        self.kurento = KurentoClient("ws://127.0.0.1:1")
+        self.kms.install(self.kurento.get_transport())
+        self.manager = RoomManager(idle_timeout=0, sweep_interval=60)
+        self.addAsyncCleanup(self.manager.close)
+
+    async def test_room_created_once(self):
+        first, second = await asyncio.gather(self.manager.get_room("room", self.kurento),
+                                             self.manager.get_room("room", self.kurento))
+        self.assertIs(first, second)
+        self.assertEqual(len(self.kms.created("MediaPipeline")), 1)
+
+    async def test_idle_room_closed(self):
+        room = await self.manager.get_room("room", self.kurento)
+        alice = await room.join("alice", FakeSession())
+        await self.manager.sweep()
+        self.assertIs(self.manager.find_room("room"), room)
+
+        await self.manager.leave_room(alice)
+        await self.manager.sweep()
+        self.assertIsNone(self.manager.find_room("room"))
+        self.assertEqual(self.kms.objects, {})
+
+    async def test_rejoined_room_kept(self):
+        room = await self.manager.get_room("room", self.kurento)
+        await self.manager.leave_room(await room.join("alice", FakeSession()))
+        self.assertIs(await self.manager.get_room("room", self.kurento), room)
+        await room.join("bob", FakeSession())
+        await self.manager.sweep()
+        self.assertIs(self.manager.find_room("room"), room)
+
+    async def test_never_joined_room_closed(self):
+        await self.manager.get_room("room", self.kurento)
+        # found empty by the first sweep, closed by the next
+        await self.manager.sweep()
+        await self.manager.sweep()
+        self.assertIsNone(self.manager.find_room("room"))
+
+
+if __name__ == '__main__':
+    unittest.main()
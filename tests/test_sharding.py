@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from collections import Counter
+
+# the examples import each other as top-level modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'examples')))
+
+from fake_kms import FakeKms, FakeSession  # noqa: E402
+from pykurento import KurentoClient  # noqa: E402
+from rooms.group_call import GroupCall  # noqa: E402
+from sharding import HashRing, WorkerChannel  # noqa: E402
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rooms = ["room-%d" % index for index in range(1000)]
+
+    def test_stable(self):
+        ring = HashRing(["a", "b", "c"])
+        again = HashRing(["c", "b", "a"])
+        self.assertEqual([ring.get(room) for room in self.rooms], [again.get(room) for room in self.rooms])
+
+    def test_spread(self):
+        ring = HashRing(["a", "b", "c", "d"])
+        counts = Counter(ring.get(room) for room in self.rooms)
+        self.assertEqual(sorted(counts), ["a", "b", "c", "d"])
+        self.assertGreater(min(counts.values()), 150)
+
+    def test_adding_a_node_moves_a_share(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [room for room in self.rooms if before.get(room) != after.get(room)]
+        # only rooms taken over by the new node move
+        self.assertTrue(all(after.get(room) == "d" for room in moved))
+        self.assertLess(len(moved), len(self.rooms) / 2)
+
+
+class Browser(object):
+    '''The front side of one websocket, as the channel sees it'''
+
+    def __init__(self):
+        self.outbound = self
+        self.queued = []
+        self.closed = None
+
+    def put(self, text):
+        self.queued.append(text)
+
+    def close(self, code=None, reason=None):
+        self.closed = (code, reason)
+
+
+class WorkerChannelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.received = []
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "worker.sock")
+        self.server = await asyncio.start_unix_server(self.worker, path=self.path)
+        self.addAsyncCleanup(self.server.wait_closed)
+        self.addCleanup(self.server.close)
+        self.channel = WorkerChannel(self.path)
+        await self.channel.connect()
+
+    async def worker(self, reader, writer):
+        self.writer = writer
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            packet = json.loads(line)
+            self.received.append(packet)
+            # answers every browser on its own connection id
+            writer.write((json.dumps(dict(conn=packet["conn"], message="echo " + packet["message"])) + "\n").encode())
+
+    async def test_replies_routed_by_connection(self):
+        alice, bob = Browser(), Browser()
+        self.channel.handlers.update(alice=alice, bob=bob)
+        await self.channel.send("alice", message="1")
+        await self.channel.send("bob", message="2")
+        await asyncio.sleep(0.05)
+        self.assertEqual([(packet["conn"], packet["message"]) for packet in self.received],
+                         [("alice", "1"), ("bob", "2")])
+        self.assertEqual((alice.queued, bob.queued), (["echo 1"], ["echo 2"]))
+
+    async def test_close_from_worker(self):
+        alice = Browser()
+        self.channel.handlers["alice"] = alice
+        await self.channel.send("alice", message="1")
+        await asyncio.sleep(0.05)
+        self.writer.write((json.dumps(dict(conn="alice", close=[1000, "bye"])) + "\n").encode())
+        await asyncio.sleep(0.05)
+        self.assertEqual(alice.closed, (1000, "bye"))
+
+    async def test_worker_gone(self):
+        alice = Browser()
+        self.channel.handlers["alice"] = alice
+        await self.channel.send("alice", message="1")
+        await asyncio.sleep(0.05)
+        self.writer.close()
+        await asyncio.sleep(0.05)
+        self.assertEqual(alice.closed, (1011, "Worker went away"))
+
+
+class GroupCallTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.kms = FakeKms()
+        kurento = KurentoClient("ws://127.0.0.1:1")
+        self.kms.install(kurento.get_transport())
+        self.group_call = GroupCall(kurento)
+        self.addAsyncCleanup(self.group_call.room_manager.close)
+
+    async def test_join_and_leave(self):
+        alice = FakeSession()
+        await self.group_call.on_message(alice, dict(id="joinRoom", room="room", name="alice"))
+        self.assertEqual(self.group_call.registry.get_by_session(alice).get_name(), "alice")
+
+        await self.group_call.on_close(alice)
+        self.assertIsNone(self.group_call.registry.get_by_session(alice))
+        self.assertTrue(self.group_call.room_manager.find_room("room").is_empty())
+
+    async def test_name_taken(self):
+        await self.group_call.on_message(FakeSession(), dict(id="joinRoom", room="room", name="alice"))
+        second = FakeSession()
+        await self.group_call.on_message(second, dict(id="joinRoom", room="room", name="alice"))
+        rejected, = second.received("joinRejected")
+        self.assertEqual(rejected["reason"], "name taken")
+        self.assertIsNone(self.group_call.registry.get_by_session(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import sys
+import unittest
+
+# the examples import each other as top-level modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'examples')))
+
+from signalling import IceCandidateBatcher, OutboundQueue, OverflowPolicy  # noqa: E402
+
+
+class IceCandidateBatcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def test_batched_per_endpoint(self):
+        batcher = IceCandidateBatcher(self.send, window=0.01)
+        for candidate in ("a1", "a2", "a3"):
+            batcher.add("alice", candidate)
+        batcher.add("bob", "b1")
+        self.assertEqual(self.sent, [])
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted((message["name"], message["candidates"]) for message in self.sent),
+                         [("alice", ["a1", "a2", "a3"]), ("bob", ["b1"])])
+        self.assertTrue(all(message["id"] == "iceCandidates" for message in self.sent))
+
+    async def test_full_batch(self):
+        batcher = IceCandidateBatcher(self.send, window=10, max_batch=2)
+        for candidate in ("a1", "a2", "a3"):
+            batcher.add("alice", candidate)
+        # sent without waiting for the window, at most max_batch per message
+        await asyncio.sleep(0)
+        self.assertEqual([message["candidates"] for message in self.sent], [["a1", "a2"], ["a3"]])
+
+    async def test_flush_on_gathering_done(self):
+        batcher = IceCandidateBatcher(self.send, window=10)
+        batcher.add("alice", "a1")
+        batcher.add("alice", "a2")
+        # what the IceGatheringDone handler does
+        await batcher.flush("alice")
+        self.assertEqual([message["candidates"] for message in self.sent], [["a1", "a2"]])
+
+        # the window's timer went with it
+        await batcher.flush("alice")
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_found_while_writing(self):
+        written = asyncio.Event()
+
+        async def slow_send(message):
+            self.sent.append(message)
+            await written.wait()
+
+        batcher = IceCandidateBatcher(slow_send, window=10)
+        batcher.add("alice", "a1")
+        flushing = asyncio.ensure_future(batcher.flush("alice"))
+        await asyncio.sleep(0)
+        batcher.add("alice", "a2")
+        # returns at once, the write in progress sends a2 next
+        await batcher.flush("alice")
+        written.set()
+        await flushing
+        self.assertEqual([message["candidates"] for message in self.sent], [["a1"], ["a2"]])
+
+    async def test_overflow(self):
+        overflowed = []
+        batcher = IceCandidateBatcher(self.send, window=10, max_batch=100, max_pending=3,
+                                      overflow=overflowed.append)
+        for candidate in ("a1", "a2", "a3"):
+            self.assertTrue(batcher.add("alice", candidate))
+        self.assertTrue(batcher.add("bob", "b1"))
+
+        self.assertFalse(batcher.add("alice", "a4"))
+        self.assertEqual(overflowed, ["alice"])
+
+        # alice's candidates are gone, bob's still go out
+        await batcher.flush_all()
+        self.assertEqual([(message["name"], message["candidates"]) for message in self.sent], [("bob", ["b1"])])
+
+
+
+class StalledSession(object):
+    """A browser websocket whose writes wait until it is let go"""
+
+    def __init__(self):
+        self.written = []
+        self.closed = None
+        self.stalled = asyncio.Event()
+
+    async def write_message(self, text):
+        await self.stalled.wait()
+        self.written.append(text)
+
+    def close(self, code=None, reason=None):
+        self.closed = (code, reason)
+
+
+class OutboundQueueTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.session = StalledSession()
+
+    async def test_written_in_order(self):
+        queue = OutboundQueue(self.session)
+        for text in ("1", "2", "3"):
+            self.assertTrue(queue.put(text))
+        self.session.stalled.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.session.written, ["1", "2", "3"])
+        self.assertEqual(len(queue), 0)
+
+    async def test_disconnect(self):
+        queue = OutboundQueue(self.session, max_queued=2)
+        queue.put("1")
+        # the writer holds 1, 2 and 3 wait
+        await asyncio.sleep(0)
+        self.assertTrue(queue.put("2"))
+        self.assertTrue(queue.put("3"))
+
+        self.assertFalse(queue.put("4"))
+        self.assertEqual(self.session.closed, (1008, "Slow consumer"))
+        self.assertTrue(queue.closed)
+        self.assertFalse(queue.put("5"))
+
+        self.session.stalled.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.session.written, ["1"])
+
+    async def test_drop_oldest(self):
+        queue = OutboundQueue(self.session, max_queued=2, overflow=OverflowPolicy.DROP_OLDEST)
+        queue.put("1")
+        await asyncio.sleep(0)
+        for text in ("2", "3", "4"):
+            self.assertTrue(queue.put(text))
+        self.assertEqual((len(queue), queue.dropped), (2, 1))
+        self.assertIsNone(self.session.closed)
+
+        self.session.stalled.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.session.written, ["1", "3", "4"])
+
+    async def test_client_gone(self):
+        async def failing(text):
+            raise ConnectionError("closed")
+        self.session.write_message = failing
+
+        queue = OutboundQueue(self.session)
+        queue.put("1")
+        queue.put("2")
+        await asyncio.sleep(0.01)
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+from pykurento.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+
+    async def fetch(self, value):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return value
+
+    async def test_coalesced(self):
+        results = await asyncio.gather(*[self.flight.do("key", self.fetch, "value") for _ in range(5)])
+        self.assertEqual(results, ["value"] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertFalse(self.flight.in_flight("key"))
+        self.assertEqual(len(self.flight), 0)
+
+        # the next call runs again
+        await self.flight.do("key", self.fetch, "value")
+        self.assertEqual(self.calls, 2)
+
+    async def test_keys_apart(self):
+        results = await asyncio.gather(self.flight.do("a", self.fetch, 1), self.flight.do("b", self.fetch, 2))
+        self.assertEqual(results, [1, 2])
+        self.assertEqual(self.calls, 2)
+
+    async def test_exception_shared(self):
+        async def failing():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("gone")
+
+        results = await asyncio.gather(*[self.flight.do("key", failing) for _ in range(3)], return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(await self.flight.do("key", self.fetch, "value"), "value")
+
+    async def test_cancelled_caller(self):
+        first = asyncio.ensure_future(self.flight.do("key", self.fetch, "value"))
+        second = asyncio.ensure_future(self.flight.do("key", self.fetch, "value"))
+        await asyncio.sleep(0)
+        first.cancel()
+        # the call goes on for the callers still waiting
+        self.assertEqual(await second, "value")
+        self.assertEqual(self.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+# the examples import each other as top-level modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'examples')))
+
+from rooms.state import KeyValueStateBackend, LocalStore, MemoryStateBackend, StateBackend  # noqa: E402
+
+ROOM = dict(pipeline="pipeline-1", mode="SFU", composite=None)
+ALICE = dict(outgoing="endpoint-1", incoming=dict(bob="endpoint-2"), hub_port=None, negotiated=True)
+BOB = dict(outgoing="endpoint-3", incoming={}, hub_port=None, negotiated=False)
+
+
+class LocalStoreTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_hash_calls(self):
+        store = LocalStore()
+        self.assertEqual(await store.hset("h", "a", "1"), 1)
+        self.assertEqual(await store.hset("h", "a", "2"), 0)
+        self.assertEqual(await store.hget("h", "a"), "2")
+        self.assertIsNone(await store.hget("h", "b"))
+        self.assertIsNone(await store.hget("missing", "a"))
+
+        await store.hset("h", "b", "3")
+        self.assertEqual(await store.hgetall("h"), dict(a="2", b="3"))
+        self.assertEqual(await store.hdel("h", "a", "c"), 1)
+        self.assertEqual(await store.hdel("h", "b"), 1)
+        # like redis, a hash without fields is gone
+        self.assertNotIn("h", store.hashes)
+        self.assertEqual(await store.hgetall("h"), {})
+
+    async def test_delete(self):
+        store = LocalStore()
+        await store.hset("a", "f", "1")
+        await store.hset("b", "f", "1")
+        self.assertEqual(await store.delete("a", "b", "c"), 2)
+        self.assertEqual(store.hashes, {})
+
+
+class StateBackendTest(unittest.IsolatedAsyncioTestCase):
+
+    def backends(self):
+        return [MemoryStateBackend(), KeyValueStateBackend(LocalStore())]
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            StateBackend()
+
+    async def test_rooms(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                await backend.save_room("room", ROOM)
+                await backend.save_room("other", dict(ROOM, pipeline="pipeline-2"))
+                self.assertEqual(await backend.get_rooms(), dict(room=ROOM, other=dict(ROOM, pipeline="pipeline-2")))
+
+                await backend.save_room("room", dict(ROOM, mode="MCU", composite="composite-1"))
+                self.assertEqual((await backend.get_rooms())["room"]["composite"], "composite-1")
+
+                await backend.remove_room("other")
+                self.assertEqual(list(await backend.get_rooms()), ["room"])
+
+    async def test_participants(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                await backend.save_room("room", ROOM)
+                await backend.save_participant("room", "alice", ALICE)
+                await backend.save_participant("room", "bob", BOB)
+                await backend.save_participant("other", "carol", BOB)
+                self.assertEqual(await backend.get_participants("room"), dict(alice=ALICE, bob=BOB))
+
+                await backend.remove_participant("room", "bob")
+                self.assertEqual(await backend.get_participants("room"), dict(alice=ALICE))
+                self.assertEqual(await backend.get_participants("missing"), {})
+
+                # a room takes its participants along
+                await backend.remove_room("room")
+                self.assertEqual(await backend.get_participants("room"), {})
+                self.assertEqual(await backend.get_participants("other"), dict(carol=BOB))
+
+    async def test_records_are_copied(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                record = dict(BOB)
+                await backend.save_participant("room", "bob", record)
+                record["outgoing"] = "changed"
+                self.assertEqual((await backend.get_participants("room"))["bob"], BOB)
+
+    async def test_prefix(self):
+        store = LocalStore()
+        first, second = KeyValueStateBackend(store, prefix="a"), KeyValueStateBackend(store, prefix="b")
+        await first.save_room("room", ROOM)
+        await first.save_participant("room", "alice", ALICE)
+        self.assertEqual(await second.get_rooms(), {})
+        self.assertEqual(await second.get_participants("room"), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import asyncio
+import unittest
+
+from pykurento.stats import StatsSampler
+
+
+class FakeEndpoint(object):
+
+    def __init__(self, object_id, tracker=None, fail=False):
+        self.id = object_id
+        self.tracker = tracker
+        self.fail = fail
+        self.bytes = 0
+
+    async def get_stats(self, media_type=None):
+        if self.tracker is not None:
+            self.tracker.running += 1
+            self.tracker.peak = max(self.tracker.peak, self.tracker.running)
+        try:
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise RuntimeError("gone")
+            self.bytes += 1000
+            return "session", {
+                "in": dict(type="inboundrtp", bytesReceived=self.bytes, packetsLost=1, jitter=0.5),
+                "out": dict(type="outboundrtp", bytesSent=2 * self.bytes, roundTripTime=0.1, remb=300000),
+            }
+        finally:
+            if self.tracker is not None:
+                self.tracker.running -= 1
+
+
+class Tracker(object):
+    running = 0
+    peak = 0
+
+
+class StatsSamplerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrency_bound(self):
+        tracker = Tracker()
+        sampler = StatsSampler(max_concurrency=3)
+        for index in range(10):
+            sampler.register(FakeEndpoint("endpoint-%d" % index, tracker))
+
+        await sampler.sample_once()
+        self.assertEqual(tracker.peak, 3)
+        self.assertEqual(len(sampler.series()), 10)
+
+    async def test_samples(self):
+        sampler = StatsSampler(history=2)
+        endpoint = FakeEndpoint("endpoint-1")
+        sampler.register(endpoint, room="room", participant="alice")
+        for _ in range(3):
+            await sampler.sample_once()
+
+        samples = sampler.series(room="room")["endpoint-1"]
+        self.assertEqual(len(samples), 2)
+        latest = sampler.latest(endpoint)
+        self.assertGreater(latest.inbound_bitrate, 0)
+        self.assertAlmostEqual(latest.outbound_bitrate, 2 * latest.inbound_bitrate)
+        self.assertEqual((latest.packets_lost, latest.rtt, latest.remb), (1, 0.1, 300000))
+        self.assertEqual(sampler.series(participant="bob"), {})
+
+    async def test_failing_endpoint_dropped(self):
+        sampler = StatsSampler(max_failures=2)
+        sampler.register(FakeEndpoint("endpoint-1", fail=True))
+        sampler.register(FakeEndpoint("endpoint-2"))
+
+        await sampler.sample_once()
+        self.assertEqual(sorted(sampler.series()), ["endpoint-1", "endpoint-2"])
+        await sampler.sample_once()
+        self.assertEqual(list(sampler.series()), ["endpoint-2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import threading
+import unittest
+
+from pykurento.events import MediaStateChanged
+from pykurento.transport import KurentoTransport, result_value
+
+
+def on_event(object_id, event_type="MediaStateChanged"):
+    return dict(jsonrpc="2.0", method="onEvent", params=dict(value=dict(
+        object=object_id, data=dict(type=event_type, source=object_id))))
+
+
+class SharedSubscriptionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.transport = KurentoTransport("ws://127.0.0.1:1")
+        self.calls = []
+        self.transport._rpc = self.rpc
+
+    async def rpc(self, rpc_type, **args):
+        self.calls.append((rpc_type, args))
+        # a moment on the wire, so concurrent subscribers overlap
+        await asyncio.sleep(0.01)
+        if rpc_type == "subscribe":
+            return "session", "kms-{object}-{type}".format(**args)
+        return "session"
+
+    def rpcs(self, rpc_type):
+        return [args for call, args in self.calls if call == rpc_type]
+
+    async def listener(self, event, name, session):
+        pass
+
+    async def test_one_kms_subscription(self):
+        first, second = await asyncio.gather(
+            self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None),
+            self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None))
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None)
+        self.assertNotEqual(first[1], second[1])
+        self.assertEqual(len(self.rpcs("subscribe")), 1)
+
+        # other objects and event types get their own
+        await self.transport.subscribe("endpoint-2", "MediaStateChanged", self.listener, None, None)
+        await self.transport.subscribe("endpoint-1", "IceCandidateFound", self.listener, None, None)
+        self.assertEqual(len(self.rpcs("subscribe")), 3)
+
+    async def test_released_with_last_listener(self):
+        listener_ids = []
+        for _ in range(3):
+            _, listener_id = await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener,
+                                                            None, None)
+            listener_ids.append(listener_id)
+
+        for listener_id in listener_ids[:-1]:
+            await self.transport.unsubscribe("endpoint-1", listener_id)
+        self.assertEqual(self.rpcs("unsubscribe"), [])
+
+        await self.transport.unsubscribe("endpoint-1", listener_ids[-1])
+        unsubscribe, = self.rpcs("unsubscribe")
+        self.assertEqual(unsubscribe["subscription"], "kms-endpoint-1-MediaStateChanged")
+
+        # the next listener subscribes on KMS again
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None)
+        self.assertEqual(len(self.rpcs("subscribe")), 2)
+
+    async def test_failed_subscription(self):
+        async def failing(rpc_type, **args):
+            raise RuntimeError("no such object")
+        self.transport._rpc = failing
+
+        with self.assertRaises(RuntimeError):
+            await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None)
+
+        # nothing is left behind, a later subscriber tries again
+        self.transport._rpc = self.rpc
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None)
+        self.assertEqual(len(self.rpcs("subscribe")), 1)
+
+    async def test_dispatched_by_source(self):
+        delivered = []
+
+        def listener(label):
+            async def fn(event, name, session):
+                delivered.append(label)
+            return fn
+
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", listener("first"), None, None)
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", listener("second"), None, None)
+        await self.transport.subscribe("endpoint-2", "MediaStateChanged", listener("other"), None, None)
+
+        await self.transport._on_message(on_event("endpoint-1"))
+        self.assertEqual(sorted(delivered), ["first", "second"])
+
+    async def test_event_built_once(self):
+        delivered = []
+
+        async def listener(event, name, session):
+            delivered.append(event)
+
+        for _ in range(2):
+            await self.transport.subscribe("endpoint-1", "MediaStateChanged", listener, None, None)
+        await self.transport._on_message(on_event("endpoint-1"))
+
+        first, second = delivered
+        self.assertIsInstance(first, MediaStateChanged)
+        self.assertIs(first, second)
+
+
+
+class ThreadedTransportTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.transport = KurentoTransport("ws://127.0.0.1:1", threaded=True)
+        self.addCleanup(self.stop)
+        self.sent = []
+        self.transport._check_connection = self.check_connection
+        self.transport.a_send_message = self.send
+
+    def stop(self):
+        self.transport.stop()
+        self.transport.io_thread.join(1)
+
+    async def check_connection(self):
+        pass
+
+    async def send(self, message):
+        # KMS answers at once
+        request = json.loads(message)
+        self.sent.append((request["method"], threading.current_thread().name))
+        result = dict(sessionId="session", value="%s-%d" % (request["method"], request["id"]))
+        self.transport.pending_operations["%d_response" % request["id"]] = dict(id=request["id"], result=result)
+
+    async def dispatch(self, message):
+        # as process_messages does, on the I/O loop
+        await self.transport._in_io_loop(self.transport._on_message(message))
+
+    async def test_requests_on_io_thread(self):
+        self.assertEqual(await self.transport.create("MediaPipeline"), ("session", "create-1"))
+        self.assertEqual(self.sent, [("create", "kurento-io")])
+
+    async def test_callbacks_on_subscribing_loop(self):
+        loop = asyncio.get_running_loop()
+        delivered = []
+
+        async def listener(event, name, session):
+            self.assertIs(asyncio.get_running_loop(), loop)
+            # the I/O loop waits for the listener, so events stay in order
+            await asyncio.sleep(0.01)
+            delivered.append(event.type)
+
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", listener, None, None)
+        await self.transport.subscribe("endpoint-1", "MediaFlowInStateChange", listener, None, None)
+        self.assertEqual([method for method, _ in self.sent], ["subscribe", "subscribe"])
+
+        await self.dispatch(on_event("endpoint-1"))
+        await self.dispatch(on_event("endpoint-1", "MediaFlowInStateChange"))
+        self.assertEqual(delivered, ["MediaStateChanged", "MediaFlowInStateChange"])
+
+    async def test_callback_exception_reaches_dispatch(self):
+        async def listener(event, name, session):
+            raise RuntimeError("handler failed")
+
+        await self.transport.subscribe("endpoint-1", "MediaStateChanged", listener, None, None)
+        with self.assertRaises(RuntimeError):
+            await self.dispatch(on_event("endpoint-1"))
+
+    async def test_unsubscribe(self):
+        _, listener_id = await self.transport.subscribe("endpoint-1", "MediaStateChanged", self.listener, None, None)
+        await self.transport.unsubscribe("endpoint-1", listener_id)
+        self.assertEqual([method for method, thread in self.sent], ["subscribe", "unsubscribe"])
+        self.assertTrue(all(thread == "kurento-io" for _, thread in self.sent))
+
+    async def listener(self, event, name, session):
+        pass
+
+
+
+class ResultValueTest(unittest.TestCase):
+
+    def test_value(self):
+        self.assertEqual(result_value(("session", 42.5)), 42.5)
+        self.assertEqual(result_value(("session", ["pipeline"])), ["pipeline"])
+
+    def test_falsy_values(self):
+        # an idle server reports a used CPU of 0.0, which is a reading all the same
+        self.assertEqual(result_value(("session", 0.0)), 0.0)
+        self.assertEqual(result_value(("session", [])), [])
+        self.assertIs(result_value(("session", False)), False)
+
+    def test_no_value(self):
+        self.assertIsNone(result_value("session"))
+        self.assertIsNone(result_value(None))
+
+if __name__ == '__main__':
+    unittest.main()